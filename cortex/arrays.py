@@ -0,0 +1,145 @@
+"""
+NumPy decoding of serialized snapshots.
+The packed DepthImage.data floats and the ColorImage.data bytes are located with the
+wire scanner (cortex.wire) and wrapped with np.frombuffer - no per-element Python work.
+Batches of snapshots can be decoded to columns (datetime, pose and feelings arrays)
+without creating a protobuf object per snapshot.
+"""
+
+import collections
+import numpy as np
+import struct
+from cortex.wire import iter_fields, scan_fields, decode_scalar, WireError, FIXED32, FIXED64
+
+SNAPSHOT_DATETIME = 1
+SNAPSHOT_POSE = 2
+SNAPSHOT_COLOR_IMAGE = 3
+SNAPSHOT_DEPTH_IMAGE = 4
+SNAPSHOT_FEELINGS = 5
+POSE_TRANSLATION, POSE_ROTATION = 1, 2
+IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DATA = 1, 2, 3
+
+DEPTH_DTYPE = np.dtype("<f4")
+COLOR_DTYPE = np.dtype("u1")
+
+SnapshotArrays = collections.namedtuple("SnapshotArrays", ["depth", "color"])
+# datetime (n,) uint64, translation (n, 3) xyz float64, rotation (n, 4) xyzw float64,
+# feelings (n, 4) hunger, thirst, exhaustion, happiness float32
+SnapshotBatch = collections.namedtuple("SnapshotBatch", ["datetime", "translation", "rotation", "feelings"])
+
+
+def _scalar(raw, fields, number):
+    if number not in fields:
+        return 0
+    wire_type, _, start, _ = fields[number][-1]
+    return decode_scalar(raw, wire_type, start)
+
+
+def _image_fields(raw, spans, number):
+    """
+    :return: (width, height, [(value start, value end) of the data field occurrences]),
+             or None if the image is missing
+    """
+    if number not in spans:
+        return None
+    _, _, start, end = spans[number][-1]
+    fields = scan_fields(raw, start, end)
+    width, height = _scalar(raw, fields, IMAGE_WIDTH), _scalar(raw, fields, IMAGE_HEIGHT)
+    data = [(value_start, value_end) for _, _, value_start, value_end in fields.get(IMAGE_DATA, [])]
+    return width, height, data
+
+
+def _frombuffer(raw, data, dtype):
+    if len(data) == 1:  # a single (packed) occurrence - a view over raw
+        start, end = data[0]
+        return np.frombuffer(raw, dtype=dtype, count=(end - start) // dtype.itemsize, offset=start)
+    # unpacked repeated values or a split payload - one copy of the joined bytes
+    return np.frombuffer(b"".join(bytes(raw[start:end]) for start, end in data), dtype=dtype)
+
+
+def depth_array(raw, spans=None):
+    """
+    :param raw: serialized snapshot (bytes-like)
+    :param spans: result of scan_fields(raw), if it was already computed
+    :return: float32 array shaped (height, width) (flat if the size doesn't match), None if there is no depth image
+    """
+    spans = scan_fields(raw) if spans is None else spans
+    image = _image_fields(raw, spans, SNAPSHOT_DEPTH_IMAGE)
+    if image is None:
+        return None
+    width, height, data = image
+    array = _frombuffer(raw, data, DEPTH_DTYPE)
+    if array.size == width * height:
+        return array.reshape(height, width)
+    return array
+
+
+def color_array(raw, spans=None):
+    """
+    :param raw: serialized snapshot (bytes-like)
+    :param spans: result of scan_fields(raw), if it was already computed
+    :return: uint8 array shaped (height, width, 3) (flat if the size doesn't match, e.g. an encoded image),
+             None if there is no color image
+    """
+    spans = scan_fields(raw) if spans is None else spans
+    image = _image_fields(raw, spans, SNAPSHOT_COLOR_IMAGE)
+    if image is None:
+        return None
+    width, height, data = image
+    array = _frombuffer(raw, data, COLOR_DTYPE)
+    if array.size == width * height * 3:
+        return array.reshape(height, width, 3)
+    return array
+
+
+def snapshot_arrays(raw):
+    """
+    :param raw: serialized snapshot (bytes-like). The returned arrays are read-only views over it
+    :return: SnapshotArrays(depth, color), a missing image is None
+    """
+    try:
+        spans = scan_fields(raw)
+        return SnapshotArrays(depth_array(raw, spans), color_array(raw, spans))
+    except WireError as e:
+        raise ValueError("couldn't decode snapshot images: {}".format(e)) from None
+
+
+def _read_fixed(raw, start, end, row, offset, count, wire_type, fmt):
+    """copy fields 1..count of the message raw[start:end] to row[offset + field number - 1]"""
+    for number, field_wire_type, _, value_start, _ in iter_fields(raw, start, end):
+        if field_wire_type == wire_type and 0 < number <= count:
+            row[offset + number - 1], = struct.unpack_from(fmt, raw, value_start)
+
+
+def snapshot_columns(records):
+    """
+    :param records: list of serialized snapshots
+    :return: SnapshotBatch of their datetime, pose and feelings. Missing values are zeros,
+             image fields are skipped without being decoded
+    """
+    n = len(records)
+    datetimes = [0] * n
+    translations = [0.0] * (3 * n)
+    rotations = [0.0] * (4 * n)
+    feelings = [0.0] * (4 * n)
+    try:
+        for i, raw in enumerate(records):
+            for number, wire_type, _, start, end in iter_fields(raw):
+                if number == SNAPSHOT_DATETIME:
+                    datetimes[i] = decode_scalar(raw, wire_type, start)
+                elif number == SNAPSHOT_POSE:
+                    for pose_number, _, _, pose_start, pose_end in iter_fields(raw, start, end):
+                        if pose_number == POSE_TRANSLATION:
+                            _read_fixed(raw, pose_start, pose_end, translations, 3 * i, 3, FIXED64, "<d")
+                        elif pose_number == POSE_ROTATION:
+                            _read_fixed(raw, pose_start, pose_end, rotations, 4 * i, 4, FIXED64, "<d")
+                elif number == SNAPSHOT_FEELINGS:
+                    _read_fixed(raw, start, end, feelings, 4 * i, 4, FIXED32, "<f")
+    except (WireError, IndexError, struct.error) as e:
+        raise ValueError("couldn't decode snapshot columns: {}".format(e)) from None
+    return SnapshotBatch(
+        np.array(datetimes, dtype=np.uint64),
+        np.array(translations, dtype=np.float64).reshape(n, 3),
+        np.array(rotations, dtype=np.float64).reshape(n, 4),
+        np.array(feelings, dtype=np.float32).reshape(n, 4),
+    )
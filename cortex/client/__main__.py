@@ -1,5 +1,10 @@
-from cortex.client import upload_sample
+from cortex.client import upload_sample, upload_samples
+from cortex.client.client import find_samples, samples_summary
+from cortex.client.uploader import UploadError
+from cortex.imaging import DEFAULT_QUALITY
+from cortex.reader import convert_sample
 import click
+import time
 
 
 @click.group()
@@ -10,9 +15,90 @@ def cli():
 @cli.command(name="upload-sample")
 @click.option('--host', '-h', default='127.0.0.1', help='Host')
 @click.option('--port', '-p', default=8000, help='Port')
+@click.option('--transport', '-t', type=click.Choice(['http', 'grpc']), default='http',
+              help='http - a request per snapshot (or batch), grpc - stream the snapshots over gRPC')
+@click.option('--prefetch', default=8, help='Number of snapshots read ahead of the upload (0 - no prefetch)')
+@click.option('--shards', '-k', default=1, help='Number of processes uploading parts of the sample in parallel')
+@click.option('--concurrency', '-c', default=1, help='Max number of snapshot requests in flight (per shard)')
+@click.option('--retries', default=3, help='Number of retries of a transient failure')
+@click.option('--adaptive/--fixed', default=True,
+              help='Adapt the number of requests in flight (up to --concurrency) to the server load')
+@click.option('--batch-size', '-b', default=1, help='Max number of snapshots sent in a single request')
+@click.option('--batch-bytes', default=0, help='Max size (bytes) of the snapshots sent in a single request')
+@click.option('--checkpoint', type=click.Path(), default=None,
+              help='Checkpoint file of the upload progress, a restarted upload resumes from it')
+@click.option('--compression', type=click.Choice(['zstd', 'gzip']), default=None,
+              help='Compress the request bodies (if the server accepts the codec)')
+@click.option('--compress-level', type=click.INT, default=None, help='Compression level (default: codec default)')
+@click.option('--compress-threshold', default=1024, help='Request bodies smaller than this (bytes) are not compressed')
+@click.option('--image-encoding', type=click.Choice(['jpeg', 'webp']), default=None,
+              help='Re-encode the raw color images before the upload')
+@click.option('--image-quality', default=DEFAULT_QUALITY, help='Quality (1-100) of the re-encoded images')
+@click.option('--image-workers', type=click.INT, default=None,
+              help='Number of processes re-encoding images (default: number of CPUs)')
 @click.argument('path', type=click.Path(exists=True))
-def cli_upload_sample(host, port, path):
-    upload_sample(host=host, port=port, path=path)
+def cli_upload_sample(host, port, transport, prefetch, shards, concurrency, retries, adaptive, batch_size, batch_bytes,
+                      checkpoint, compression, compress_level, compress_threshold, image_encoding, image_quality,
+                      image_workers, path):
+    try:
+        result = upload_sample(host=host, port=port, path=path, transport=transport, prefetch=prefetch,
+                               shards=shards, concurrency=concurrency, retries=retries, adaptive=adaptive,
+                               batch_size=batch_size, batch_bytes=batch_bytes, checkpoint=checkpoint,
+                               compression=compression, compress_level=compress_level,
+                               compress_threshold=compress_threshold, image_encoding=image_encoding,
+                               image_quality=image_quality, image_workers=image_workers)
+    except UploadError as e:
+        raise click.ClickException(str(e))
+    if result is None:
+        return
+    click.echo(f'{result.uploaded} snapshots were uploaded, {len(result.failed)} failed.')
+    for snapshot_id in result.failed_ids:
+        click.echo(f'snapshot {snapshot_id}: {result.failed[snapshot_id]}')
+
+
+@cli.command(name="upload-samples")
+@click.option('--host', '-h', default='127.0.0.1', help='Host')
+@click.option('--port', '-p', default=8000, help='Port')
+@click.option('--processes', '-j', default=4, help='Number of samples uploaded in parallel')
+@click.option('--connections', default=16, help='Max number of requests in flight across all the samples')
+@click.option('--transport', '-t', type=click.Choice(['http', 'grpc']), default='http',
+              help='http - a request per snapshot (or batch), grpc - stream the snapshots over gRPC')
+@click.option('--prefetch', default=8, help='Number of snapshots read ahead of the upload (0 - no prefetch)')
+@click.option('--concurrency', '-c', default=4, help='Max number of snapshot requests in flight (per sample)')
+@click.option('--retries', default=3, help='Number of retries of a transient failure')
+@click.option('--adaptive/--fixed', default=True,
+              help='Adapt the number of requests in flight (up to --concurrency) to the server load')
+@click.option('--batch-size', '-b', default=1, help='Max number of snapshots sent in a single request')
+@click.option('--batch-bytes', default=0, help='Max size (bytes) of the snapshots sent in a single request')
+@click.option('--compression', type=click.Choice(['zstd', 'gzip']), default=None,
+              help='Compress the request bodies (if the server accepts the codec)')
+@click.argument('pattern')
+def cli_upload_samples(host, port, processes, connections, transport, prefetch, concurrency, retries, adaptive,
+                       batch_size, batch_bytes, compression, pattern):
+    """Upload the samples of a directory (or matching a glob pattern) with a pool of processes"""
+    paths = find_samples(pattern)
+    if not paths:
+        click.echo(f'no samples were found: {pattern}')
+        return
+    start = time.monotonic()
+    results = upload_samples(host=host, port=port, paths=paths, processes=processes, connections=connections,
+                             transport=transport,
+                             prefetch=prefetch, concurrency=concurrency, retries=retries, adaptive=adaptive,
+                             batch_size=batch_size, batch_bytes=batch_bytes, compression=compression)
+    for line in samples_summary(results, time.monotonic() - start):
+        click.echo(line)
+
+
+@cli.command(name="convert-sample")
+@click.option('--format', '-f', 'sample_format', type=click.Choice(['gzip', 'zstd', 'raw']), default=None,
+              help='Container format of the new sample (default: by its extension - .gz, .zst, other - raw)')
+@click.option('--level', '-l', type=click.INT, default=None, help='Compression level')
+@click.argument('src', type=click.Path(exists=True))
+@click.argument('dst', type=click.Path())
+def cli_convert_sample(sample_format, level, src, dst):
+    """Rewrite a sample in another container format, e.g. raw or zstd for samples that are replayed often"""
+    count = convert_sample(src, dst, format=sample_format, level=level)
+    click.echo(f'{count} snapshots were written to {dst}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+import time
+
+WARNING_PREFIX = "WARNING: "
+
+
+class Checkpoint:
+    def __init__(self, path, sample, user_id, last_acked=0, save_every=100, save_interval=5.0):
+        """
+        Upload progress of a sample: the last snapshot id such that it and all the ids before it
+        (from the start of the upload range) were acknowledged by the server.
+        Acknowledgements may arrive out of order (concurrent uploads), ids above the first
+        missing one are kept in memory until the gap is filled.
+
+        :param path: checkpoint file
+        :param sample: path to the sample (a checkpoint of another sample is ignored)
+        :param user_id: user of the sample
+        :param last_acked: id of the last acknowledged snapshot, 0 - nothing was uploaded
+        :param save_every: save the checkpoint every save_every acknowledgements...
+        :param save_interval: ...or every save_interval seconds
+        """
+        self.path = path
+        self.sample = os.path.abspath(sample)
+        self.user_id = user_id
+        self.last_acked = last_acked
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self._acked = set()  # acknowledged ids above last_acked + 1
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, sample, user_id, first_id=1, **kwargs):
+        """
+        :param first_id: first snapshot id of the upload range
+        :return: Checkpoint resumed from path if it belongs to the sample, otherwise a new one
+        """
+        checkpoint = cls(path, sample, user_id, last_acked=first_id - 1, **kwargs)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return checkpoint
+        except (OSError, ValueError):
+            print(WARNING_PREFIX, "couldn't read checkpoint {}, the upload starts over.".format(path))
+            return checkpoint
+        if data.get("sample") != checkpoint.sample or data.get("user_id") != user_id:
+            print(WARNING_PREFIX, "checkpoint {} belongs to another sample, the upload starts over.".format(path))
+            return checkpoint
+        checkpoint.last_acked = max(checkpoint.last_acked, data.get("last_acked", 0))
+        return checkpoint
+
+    def ack(self, snapshot_ids):
+        """mark snapshots as acknowledged by the server"""
+        with self._lock:
+            self._acked.update(snapshot_ids)
+            while self.last_acked + 1 in self._acked:
+                self.last_acked += 1
+                self._acked.discard(self.last_acked)
+            self._unsaved += len(snapshot_ids)
+            if self._unsaved >= self.save_every or time.monotonic() - self._saved_at >= self.save_interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sample": self.sample, "user_id": self.user_id, "last_acked": self.last_acked}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
@@ -1,10 +1,21 @@
+import glob
+import multiprocessing
+import os
+import queue
 import requests
-from pathlib import Path
-from secrets import token_hex
-from cortex.reader import Reader, serialize
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cortex.compression import choose_codec
+from cortex.formats import formats
+from cortex.imaging import DEFAULT_QUALITY
+from cortex.lazy import SNAPSHOT_FIELDS
+from cortex.reader import Reader
+from .checkpoint import Checkpoint
+from .uploader import (ConcurrentUploader, UploadError, UploadResult, OVERLOAD_STATUS, TRANSIENT_STATUS,
+                       parse_retry_after, retry_delay)
 
 ERROR_PREFIX = "ERROR: "
-TIMEOUT_PREFIX = "TIMEOUT: "
+WARNING_PREFIX = "WARNING: "
 
 
 def validate_attr(attr, default_val, path):
@@ -14,94 +25,213 @@ def validate_attr(attr, default_val, path):
     return True
 
 
-def send_request(url, data, filename="", headers=None, timeout=10):
-    try:
-        if filename != "":
-            files = {'file': (str(filename), open(filename, 'rb'))}
-            r = requests.post(url, data=data, files=files, timeout=timeout)
+def send_request(url, data, headers=None, timeout=10, session=None, retries=3, backoff=0.5):
+    """
+    :param data: form dict or request body (bytes)
+    :param session: requests.Session to send the request with (a new connection is opened otherwise)
+    :param retries: number of retries of timeouts and overload responses (429/503, honoring Retry-After)
+    :param backoff: base delay (seconds) of the jittered exponential backoff between retries
+    :return: response
+    :raise UploadError: the request failed (the last failure, once the retries are exhausted)
+    """
+    attempt = 0
+    while True:
+        retry_after = None
+        try:
+            r = (session or requests).post(url, data=data, headers=headers, timeout=timeout)
+        except requests.exceptions.Timeout:
+            if attempt >= retries:
+                raise UploadError("request timed out ({} attempts)".format(attempt + 1),
+                                  transient=True, overloaded=True) from None
+        except (requests.exceptions.RequestException, ConnectionError):
+            # catastrophic failure
+            raise UploadError("server is currently unavailable", transient=True) from None
         else:
-            r = requests.post(url, data=data, headers=headers, timeout=timeout)
-    except requests.exceptions.Timeout:
-        print(TIMEOUT_PREFIX, "Couldn't upload the data. Please, try again latter.")
-        return None
-    except (requests.exceptions.RequestException, ConnectionError) as e:
-        # catastrophic failure
-        print(ERROR_PREFIX, "Server is currently unavailable.")
-        # print(e)
-        return None
-
-    if r.status_code != requests.codes.ok:
-        print(ERROR_PREFIX, "Couldn't upload the data. Response status:", r.status_code)
-        return None
-    return r
-
-
-def upload_user(base_url, user):
+            if r.status_code == requests.codes.ok:
+                return r
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            if r.status_code not in OVERLOAD_STATUS or attempt >= retries:
+                raise UploadError("response status: {} ({} attempts)".format(r.status_code, attempt + 1),
+                                  r.status_code in TRANSIENT_STATUS, r.status_code in OVERLOAD_STATUS, retry_after)
+        time.sleep(retry_delay(attempt, backoff, retry_after))
+        attempt += 1
+
+
+def upload_user(base_url, user, session=None):
+    """
+    :return: server configuration: {"parsers": [parser, ...], "fields": {parser: [snapshot field, ...]}}
+             ("fields" may be missing for older servers), None if the server reported an error
+    :raise UploadError: the request failed
+    """
     url = "{}/new_user".format(base_url)
-    r = send_request(url, user)
-    if r:
-        try:
-            config = r.json()
-            if "parsers" in config:
-                return config["parsers"]
-            if "error" in config:
-                print(ERROR_PREFIX, config["error"])
-        except ValueError:  # json parsing error
-            print(ERROR_PREFIX, "couldn't parse json. Print response as text:", r.text)
+    try:
+        r = send_request(url, user, session=session)
+    except UploadError as e:
+        raise UploadError("couldn't upload the user: {}".format(e), e.transient, e.overloaded, e.retry_after) from None
+    try:
+        config = r.json()
+        if "parsers" in config:
+            return config
+        if "error" in config:
+            print(ERROR_PREFIX, config["error"])
+    except ValueError:  # json parsing error
+        print(ERROR_PREFIX, "couldn't parse json. Print response as text:", r.text)
     return None
 
 
-def upload_snapshot(base_url, user_id, snapshot, snapshot_id, parsers=None):
-    url = "{}/snapshot/{}/{}".format(base_url, user_id, snapshot_id)
-    # print("snapshot fields list:", len(snapshot.ListFields()))
+def needed_fields(config):
+    """
+    :param config: server configuration (as returned by upload_user)
+    :return: names of the snapshot fields consumed by the server parsers
+    """
+    snapshot_fields = set(SNAPSHOT_FIELDS)
+    if "fields" in config:
+        needed = {field for fields in config["fields"].values() for field in fields}
+    else:  # older servers: parsers are named after the fields they parse
+        needed = set(config["parsers"])
+    return sorted(needed & snapshot_fields)
 
-    acceptable_fields = []  # snapshot fields that can be parsed
-    if parsers is not None:
-        for parser in parsers:
-            try:
-                if snapshot.HasField(parser):
-                    acceptable_fields.append(parser)
-            except ValueError:
-                # redundant parser
-                pass
-
-    # print("accept", acceptable_fields)
-
-    # send a snapshot as file
-    # attempt to send serialized proto object as is resulted in error
-    # r = send_request(url, snapshot.SerializeToString())  # too big
-    # create tmp file
-    snapfiles_path = Path("/tmp/snapfiles/")
-    snapfiles_path.mkdir(parents=True, exist_ok=True)
-    snapfile_path = snapfiles_path / ("snap_" + token_hex(5) + ".bytes")
-    with open(snapfile_path, "wb") as f:
-        f.write(serialize(snapshot))
-    # send file to server
-    r = send_request(url, data=None, filename=snapfile_path)
-
-    if r:
+
+def split_ranges(count, shards):
+    """
+    :param count: number of snapshots
+    :param shards: number of ranges
+    :return: list of up to shards contiguous (start, stop) snapshot ranges of about the same size
+    """
+    shards = max(min(shards, count), 1)
+    bounds = [count * i // shards for i in range(shards + 1)]
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if start < stop]
+
+
+def iter_snapshots(reader, stop=None):
+    """
+    :param stop: index of the first snapshot not to read, None - read till the end of the sample
+    :return: yields (snapshot_id, snapshot) from the current position of reader.
+             snapshot ids are global: snapshot i of the sample (0 based) has snapshot_id i + 1
+    """
+    while stop is None or reader.position < stop:
+        try:
+            snapshot = next(reader)
+        except StopIteration:
+            return
+        yield reader.position, snapshot
+
+
+def upload_snapshots(base_url, reader, user_id, stop=None, options=None, checkpoint=None):
+    """
+    upload the snapshots of reader from its current position
+    (pass fields=... in options to send only the fields consumed by the server)
+
+    :param stop: index of the first snapshot not to upload, None - upload till the end of the sample
+    :param options: ConcurrentUploader keyword arguments (concurrency, retries, batch_size, ...),
+                    with transport="grpc" and grpc_target="host:port" - GrpcUploader keyword arguments
+    :param checkpoint: path to a checkpoint file. The upload resumes after the last snapshot acknowledged
+                       by a previous run, and the file is updated as snapshots are acknowledged
+    :return: UploadResult
+    """
+    progress = None
+    if checkpoint is not None:
+        progress = Checkpoint.load(checkpoint, reader.filename, user_id, first_id=reader.position + 1)
+        if progress.last_acked > reader.position:  # snapshot i has snapshot_id i + 1
+            reader.seek(min(progress.last_acked, len(reader)))
+    options = dict(options or {})
+    if options.pop("transport", "http") == "grpc":
+        from .grpc_uploader import GrpcUploader  # grpcio is needed only here
+        uploader = GrpcUploader(options.pop("grpc_target"), user_id, **options)
+    else:
+        uploader = ConcurrentUploader(base_url, user_id, **options)
+    return uploader.upload(iter_snapshots(reader, stop), progress)
+
+
+def _upload_shard(base_url, path, index, start, stop, user_id, prefetch, options, checkpoint, results):
+    """worker process: upload snapshots [start, stop) of the sample"""
+    fields = (options or {}).get("fields")
+    with Reader(path, prefetch=prefetch, index=index, fields=fields) as reader:
+        reader.seek(start)
+        results.put((start, upload_snapshots(base_url, reader, user_id, stop, options, checkpoint)))
+
+
+def upload_shards(base_url, reader, user_id, shards, prefetch=8, options=None, checkpoint=None):
+    """
+    split the sample into contiguous snapshot ranges and upload each of them in its own process
+
+    :param reader: Reader of the sample
+    :param shards: number of worker processes
+    :param prefetch: read ahead of every worker (see Reader)
+    :param options: ConcurrentUploader keyword arguments of every worker
+    :param checkpoint: path prefix of the checkpoint files - one per range (<checkpoint>.<start>-<stop>),
+                       so resuming an upload requires the same number of shards
+    :return: UploadResult
+    """
+    ranges = split_ranges(len(reader), shards)
+    # forked workers inherit the index together with its restore points,
+    # so each of them starts inflating right at its range (spawned workers get the record table and the gzip
+    # member starts only, see SampleIndex.__getstate__)
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    results = context.Queue()
+    workers = [context.Process(target=_upload_shard,
+                               args=(base_url, reader.filename, reader.index, start, stop,
+                                     user_id, prefetch, options,
+                                     checkpoint and "{}.{}-{}".format(checkpoint, start, stop), results))
+               for start, stop in ranges]
+    for worker in workers:
+        worker.start()
+    result = UploadResult()
+    reported = set()
+    # results are read while the workers run, a worker can't exit before its result was read
+    while len(reported) < len(ranges):
         try:
-            resp = r.json()
-            if "error" in resp:
-                print(ERROR_PREFIX, resp["error"])
-        except ValueError:  # json parsing error
-            pass
-            # resp = r.text
-            # print("Couldn't parse json. Print response as text:", resp)
+            start, shard_result = results.get(timeout=0.5)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers) and results.empty():
+                break
+            continue
+        result.merge(shard_result)
+        reported.add(start)
+    for worker in workers:
+        worker.join()
+    for start, stop in ranges:
+        if start not in reported:  # the worker crashed, its range is reported as failed
+            result.failed.update({i + 1: "upload worker failed" for i in range(start, stop)})
+    return result
 
 
-def upload_sample(host='127.0.0.1', port=8000, path=""):
+def upload_sample(host='127.0.0.1', port=8000, path="", prefetch=8, shards=1, concurrency=1, retries=3,
+                  batch_size=1, batch_bytes=0, checkpoint=None, compression=None, compress_level=None,
+                  compress_threshold=1024, image_encoding=None, image_quality=DEFAULT_QUALITY, image_workers=None,
+                  connections=None, adaptive=True, transport="http"):
     """
-    Upload a sample by providing host, port and path to gz file.
-    Gz file is expected to include user data and a list of snapshots serialized with google protobuf.
+    Upload a sample by providing host, port and path to the sample file (gzip, zstd or raw - see cortex.formats).
+    The sample is expected to include user data and a list of snapshots serialized with google protobuf.
     For more info please see cortes.proto file.
 
     :param host:
     :param port:
-    :param path: path to gz data file
-    :return: void
+    :param path: path to the sample file
+    :param prefetch: number of snapshots inflated and parsed ahead of the upload (0 - no prefetch)
+    :param shards: number of processes uploading contiguous snapshot ranges of the sample in parallel
+    :param concurrency: max number of snapshot requests in flight (per shard)
+    :param retries: number of retries of a transient failure (timeouts, connection errors, 429/5xx)
+    :param batch_size: max number of snapshots sent in a single request (batch endpoint if > 1)
+    :param batch_bytes: max size (bytes) of the snapshots sent in a single request, 0 - no limit
+    :param checkpoint: path to a checkpoint file recording the last acknowledged snapshot id,
+                       a restarted upload resumes from it
+    :param compression: preferred codec of the request bodies ("zstd" or "gzip"), None - no compression.
+                        Falls back to another codec accepted by the server (or to no compression)
+    :param compress_level: compression level, None - the codec default
+    :param compress_threshold: smaller request bodies (bytes) are sent uncompressed
+    :param image_encoding: re-encode the raw color images to "jpeg" or "webp" before the upload, None - send raw
+    :param image_quality: quality (1-100) of the re-encoded images
+    :param image_workers: number of processes re-encoding images (per shard), None - number of CPUs
+    :param connections: semaphore capping the requests in flight across uploads (see upload_samples)
+    :param adaptive: adapt the number of requests in flight (up to concurrency) to the server load
+    :param transport: "http" - a request per snapshot (or batch), "grpc" - stream the snapshots over the gRPC
+                      service of the server (see cortex.client.grpc_uploader), if it advertises one
+    :return: UploadResult (uploaded count and failed snapshot ids), None if the sample has no valid user
+             (or the server rejected it)
+    :raise UploadError: the user couldn't be uploaded
     """
-    with Reader(path) as reader:
+    with Reader(path, prefetch=prefetch if shards <= 1 else 0) as reader:
         new_user = {}
         user_id = reader.user_id
         if not validate_attr(user_id, -1, path):
@@ -130,11 +260,103 @@ def upload_sample(host='127.0.0.1', port=8000, path=""):
 
         base_url = "" if "http" in host else "http://"
         base_url += "{}:{}".format(host, port)
-        parsers = upload_user(base_url, new_user)
-
-        if parsers is not None:  # if no error (on error, parsers = None)
-            snapshot_id = 1
-            for snapshot in reader:
-                # print(snapshot.datetime, snapshot.color_image.width, snapshot.color_image.height)
-                upload_snapshot(base_url, user_id, snapshot, snapshot_id, parsers)
-                snapshot_id += 1
+        config = upload_user(base_url, new_user)
+
+        if config is not None:  # if no error (on error, config = None)
+            # send only the fields consumed by the server parsers
+            # the reader doesn't even decode the others (see LazySnapshot)
+            fields = needed_fields(config)
+            reader.fields = fields
+            # older servers don't advertise codecs, they only accept uncompressed bodies
+            codec = choose_codec(compression, config.get("codecs", []))
+            if compression is not None and codec != compression:
+                print(WARNING_PREFIX, "the server doesn't accept {} bodies, using: {}".format(compression, codec))
+            options = dict(concurrency=concurrency, retries=retries, batch_size=batch_size, batch_bytes=batch_bytes,
+                           fields=fields, compression=codec,
+                           compress_level=compress_level if codec == compression else None,
+                           compress_threshold=compress_threshold, image_encoding=image_encoding,
+                           image_quality=image_quality, image_workers=image_workers, connections=connections,
+                           adaptive=adaptive)
+            if transport == "grpc":
+                if "grpc_port" in config:
+                    options.update(transport="grpc", grpc_target="{}:{}".format(host.split("://")[-1],
+                                                                                config["grpc_port"]))
+                else:
+                    print(WARNING_PREFIX, "the server doesn't serve gRPC uploads, using http.")
+            if shards > 1:
+                return upload_shards(base_url, reader, user_id, shards, prefetch, options, checkpoint)
+            return upload_snapshots(base_url, reader, user_id, options=options, checkpoint=checkpoint)
+
+
+def find_samples(pattern):
+    """
+    :param pattern: directory (its sample files - .gz, .zst or .sample - are taken) or glob pattern
+    :return: sorted list of sample paths
+    """
+    if os.path.isdir(pattern):
+        suffixes = tuple(sample_format.suffix for sample_format in formats.values())
+        return sorted(entry.path for entry in os.scandir(pattern) if entry.is_file() and entry.name.endswith(suffixes))
+    return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+
+_connections = None  # global cap of the requests in flight, set in every upload_samples worker
+
+
+def _init_samples_worker(connections):
+    global _connections
+    _connections = connections
+
+
+def _upload_samples_worker(path, kwargs):
+    """worker process of upload_samples: upload a single sample"""
+    return upload_sample(path=path, connections=_connections, **kwargs)
+
+
+def upload_samples(host='127.0.0.1', port=8000, paths=(), processes=4, connections=16, **kwargs):
+    """
+    Upload many samples, each of them in a worker process of a pool
+
+    :param paths: paths to the sample files (see find_samples)
+    :param processes: number of samples uploaded in parallel
+    :param connections: max number of requests in flight across all the workers
+    :param kwargs: upload_sample keyword arguments of every sample (concurrency, batch_size, ...)
+    :return: {path: UploadResult, or an error message if the sample couldn't be uploaded}
+    """
+    results = {}
+    connections = multiprocessing.BoundedSemaphore(max(connections, 1))
+    kwargs = dict(kwargs, host=host, port=port, shards=1)
+    with ProcessPoolExecutor(max(processes, 1), initializer=_init_samples_worker, initargs=(connections,)) as pool:
+        futures = {path: pool.submit(_upload_samples_worker, path, kwargs) for path in paths}
+        for path, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:  # corrupt sample, crashed worker...
+                results[path] = str(e) or type(e).__name__
+                continue
+            results[path] = result if result is not None else "the user couldn't be uploaded"
+    return results
+
+
+def samples_summary(results, elapsed):
+    """
+    :param results: return value of upload_samples
+    :param elapsed: duration of the upload (seconds)
+    :return: lines of a throughput summary: failures per file and totals (snapshots/s, MB/s)
+    """
+    lines = []
+    uploaded = failed = sent_bytes = 0
+    for path, result in results.items():
+        if isinstance(result, str):
+            lines.append("{}: failed - {}".format(path, result))
+            continue
+        uploaded += result.uploaded
+        failed += len(result.failed)
+        sent_bytes += result.sent_bytes
+        if result.failed:
+            lines.append("{}: {} snapshots failed (ids {})".format(
+                path, len(result.failed), ", ".join(map(str, result.failed_ids[:10])) +
+                (", ..." if len(result.failed) > 10 else "")))
+    elapsed = max(elapsed, 1e-9)
+    lines.append("{} samples, {} snapshots uploaded, {} failed in {:.1f}s: {:.1f} snapshots/s, {:.2f} MB/s".format(
+        len(results), uploaded, failed, elapsed, uploaded / elapsed, sent_bytes / elapsed / 1e6))
+    return lines
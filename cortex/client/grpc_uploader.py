@@ -0,0 +1,146 @@
+import grpc
+import threading
+import time
+from google.protobuf.empty_pb2 import Empty
+from .uploader import ConcurrentUploader, UploadResult, retry_delay
+
+UPLOAD_SAMPLE_METHOD = "/Cortex/UploadSample"  # see cortex.proto
+MAX_MESSAGE_LENGTH = 64 << 20
+# status codes worth retrying
+TRANSIENT_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.RESOURCE_EXHAUSTED,
+                   grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.ABORTED}
+
+
+def accepted_count(error):
+    """:return: number of snapshots the server accepted before the call failed (trailing metadata), 0 if unknown"""
+    try:
+        metadata = dict(error.trailing_metadata() or ())
+        return int(metadata.get("count", 0))
+    except (AttributeError, ValueError):
+        return 0
+
+
+class _Stream:
+    def __init__(self, bodies, first, max_count, max_bytes):
+        """
+        request iterator of a stream: consecutive snapshots pulled from bodies as they are streamed
+        (by a gRPC thread), until max_count snapshots or max_bytes
+
+        :param bodies: iterator of (snapshot_id, serialized snapshot)
+        :param first: first (snapshot_id, serialized snapshot) of the stream
+        """
+        self.start = first[0]
+        self.sent = []  # (snapshot_id, serialized snapshot) streamed so far
+        self.pending = first  # next snapshot of bodies, None - bodies are exhausted
+        self._bodies = bodies
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        size = 0
+        while True:
+            with self._lock:
+                pending = self.pending
+                if self._closed or pending is None or len(self.sent) >= self._max_count or \
+                        (self.sent and (size + len(pending[1]) > self._max_bytes or
+                                        pending[0] != self.sent[-1][0] + 1)):
+                    return
+                self.sent.append(pending)
+                size += len(pending[1])
+                self.pending = next(self._bodies, None)
+            yield pending[1]
+
+    def close(self):
+        """stop streaming (the call is over) - sent and pending are final"""
+        with self._lock:
+            self._closed = True
+
+
+class GrpcUploader(ConcurrentUploader):
+    def __init__(self, target, user_id, stream_size=1000, stream_bytes=64 << 20, **kwargs):
+        """
+        Upload snapshots over the Cortex.UploadSample client streaming RPC (see cortex.server.grpc_server):
+        consecutive snapshots are streamed over a single long-lived HTTP/2 stream instead of a request each.
+        Snapshots are read from the iterator as they are streamed. A stream ends after stream_size snapshots
+        (or stream_bytes), its snapshots are kept until it completes to be re-sent if it fails.
+
+        :param target: host:port of the gRPC service
+        :param stream_size: max number of snapshots per stream
+        :param stream_bytes: max size (bytes) of the snapshots of a stream
+        :param kwargs: ConcurrentUploader options - retries, backoff, timeout (of a stream, None - no deadline),
+                       fields, image re-encoding. compression (any codec) compresses the messages with gzip
+                       (the codec of gRPC). Concurrency and batching options don't apply
+        """
+        kwargs.setdefault("timeout", None)
+        super().__init__(target, user_id, **kwargs)
+        self.target = target
+        self.stream_size = max(stream_size, 1)
+        self.stream_bytes = stream_bytes
+
+    def _call(self, upload_sample, start, requests):
+        metadata = (("user-id", str(self.user_id)), ("start", str(start)))
+        compression = grpc.Compression.Gzip if self.compression is not None else None
+        if self.connections is None:
+            upload_sample(iter(requests), timeout=self.timeout, metadata=metadata, compression=compression)
+        else:  # a stream takes one of the connections shared with other uploads
+            with self.connections:
+                upload_sample(iter(requests), timeout=self.timeout, metadata=metadata, compression=compression)
+
+    def _send_stream(self, upload_sample, stream, result, checkpoint):
+        """stream the snapshots of stream, retrying transient failures with the snapshots that weren't accepted"""
+        start, sent, attempt = stream.start, None, 0
+        while True:
+            error = None
+            try:
+                self._call(upload_sample, start, stream if sent is None else [body for _, body in sent])
+            except grpc.RpcError as e:
+                error = e
+            if sent is None:  # first attempt, the snapshots were pulled from the reader while streaming
+                stream.close()
+                sent = stream.sent
+            # the server reports the snapshots it accepted before a failure, only the others are re-sent
+            # (a snapshot accepted twice is dropped by the server anyway)
+            accepted = len(sent) if error is None else accepted_count(error)
+            self._acked(result, sent[:accepted], checkpoint)
+            sent = sent[accepted:]
+            if not sent:
+                return
+            if error.code() not in TRANSIENT_CODES or attempt >= self.retries:
+                result.failed.update({snapshot_id: "{}: {}".format(error.code().name, error.details())
+                                      for snapshot_id, _ in sent})
+                return
+            time.sleep(retry_delay(attempt, self.backoff))
+            attempt += 1
+            start = sent[0][0]
+
+    def upload(self, snapshots, checkpoint=None):
+        """
+        :param snapshots: iterable of (snapshot_id, snapshot object or serialized snapshot)
+        :param checkpoint: Checkpoint updated with the acknowledged snapshot ids
+        :return: UploadResult
+        """
+        result = UploadResult()
+        channel = grpc.insecure_channel(self.target, options=[("grpc.max_send_message_length", MAX_MESSAGE_LENGTH)])
+        upload_sample = channel.stream_unary(UPLOAD_SAMPLE_METHOD, request_serializer=None,
+                                             response_deserializer=Empty.FromString)
+        bodies = iter(self._reencoded(self._serialized(snapshots)))
+        try:
+            pending = next(bodies, None)
+            while pending is not None:
+                stream = _Stream(bodies, pending, self.stream_size, self.stream_bytes)
+                self._send_stream(upload_sample, stream, result, checkpoint)
+                pending = stream.pending
+        finally:
+            channel.close()
+            if checkpoint is not None:
+                checkpoint.save()
+        return result
+
+    @staticmethod
+    def _acked(result, sent, checkpoint):
+        result.uploaded += len(sent)
+        result.sent_bytes += sum(len(body) for _, body in sent)
+        if checkpoint is not None and sent:
+            checkpoint.ack([snapshot_id for snapshot_id, _ in sent])
@@ -0,0 +1,423 @@
+import collections
+import email.utils
+import os
+import random
+import requests
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cortex.compression import compress
+from cortex.formats import frame_records
+from cortex.imaging import DEFAULT_QUALITY, reencode_snapshot
+from cortex.reader import serialize, serialize_fields
+
+SNAPSHOT_CONTENT_TYPE = "application/x-protobuf"
+# response statuses worth retrying
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+# response statuses of an overloaded server (the request rate should drop)
+OVERLOAD_STATUS = {429, 503}
+
+
+class UploadError(Exception):
+    def __init__(self, message, transient=False, overloaded=False, retry_after=None):
+        """
+        :param transient: the request may succeed if retried
+        :param overloaded: the server is overloaded (429/503 or a timeout)
+        :param retry_after: delay (seconds) requested by the server (Retry-After header), None - not supplied
+        """
+        super().__init__(message)
+        self.transient = transient
+        self.overloaded = overloaded
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header - delay in seconds or an HTTP date
+    :return: delay in seconds, None if missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+def retry_delay(attempt, backoff, retry_after=None):
+    """
+    :param attempt: number of the failed attempt (0 based)
+    :param backoff: base delay (seconds) of the jittered exponential backoff
+    :param retry_after: delay requested by the server, if any
+    :return: delay (seconds) before the next attempt - jittered, at least retry_after
+    """
+    delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+    if retry_after is not None:
+        # spread the retries of the clients the server turned away at the same moment
+        delay = max(delay, retry_after * random.uniform(1.0, 1.2))
+    return delay
+
+
+def create_session(pool_size=10):
+    """
+    :param pool_size: number of kept-alive connections
+    :return: requests.Session reusing its connections (HTTP keep-alive) between requests
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def snapshot_url(base_url, user_id, snapshot_id):
+    return "{}/snapshot/{}/{}".format(base_url, user_id, snapshot_id)
+
+
+def batch_url(base_url, user_id, start):
+    return "{}/snapshots/{}?start={}".format(base_url, user_id, start)
+
+
+def post_snapshot(session, url, body, headers=None, timeout=10):
+    """
+    post a serialized snapshot
+
+    :param session: requests.Session
+    :param body: serialized snapshot
+    :return: response
+    :raise UploadError: on failure, transient failures (timeouts, connection errors, 429/5xx) are marked as such,
+                        as well as signs of an overloaded server (timeouts, 429/503 and their Retry-After)
+    """
+    headers = dict(headers or {}, **{"Content-Type": SNAPSHOT_CONTENT_TYPE})
+    try:
+        r = session.post(url, data=body, headers=headers, timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise UploadError("request timed out", transient=True, overloaded=True) from None
+    except (requests.exceptions.RequestException, ConnectionError):
+        raise UploadError("server is currently unavailable", transient=True) from None
+
+    if r.status_code != requests.codes.ok:
+        raise UploadError("response status: {}".format(r.status_code), r.status_code in TRANSIENT_STATUS,
+                          r.status_code in OVERLOAD_STATUS, parse_retry_after(r.headers.get("Retry-After")))
+    try:
+        resp = r.json()
+    except ValueError:  # empty or non json response
+        return r
+    if isinstance(resp, dict) and "error" in resp:
+        raise UploadError(resp["error"])
+    return r
+
+
+class UploadResult:
+    """per-snapshot outcome of an upload"""
+
+    def __init__(self):
+        self.uploaded = 0
+        self.failed = {}  # {snapshot_id: error message}
+        self.sent_bytes = 0  # size of the request bodies of the uploaded snapshots
+
+    def __repr__(self):
+        return "UploadResult(uploaded={}, failed={}, sent_bytes={})".format(self.uploaded, len(self.failed),
+                                                                           self.sent_bytes)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def failed_ids(self):
+        return sorted(self.failed)
+
+    def merge(self, other):
+        self.uploaded += other.uploaded
+        self.failed.update(other.failed)
+        self.sent_bytes += other.sent_bytes
+        return self
+
+
+class AdaptiveLimit:
+    def __init__(self, max_limit, min_limit=1, latency_tolerance=2.0, decrease=0.5, smoothing=0.2):
+        """
+        AIMD limit of the requests in flight: the limit grows by one per round trip of successful requests
+        (additive increase) and is cut by `decrease` (multiplicative decrease) when the server is overloaded -
+        429/503, timeouts, or a smoothed latency above latency_tolerance times the baseline (the lowest
+        recent latency, slowly forgotten so that a lasting change of the server becomes the new baseline).
+
+        :param max_limit: initial and max number of requests in flight
+        :param min_limit: min number of requests in flight (max_limit - fixed limit)
+        :param latency_tolerance: latency increase (ratio to the baseline) considered as overload
+        :param decrease: factor of the multiplicative decrease
+        :param smoothing: weight of the last latency in the smoothed latency
+        """
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.latency = None  # smoothed latency (seconds)
+        self.min_latency = None  # baseline latency (seconds)
+        self._decreased_at = float("-inf")
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return "AdaptiveLimit(limit={:.1f}, in_flight={})".format(self.limit, self.in_flight)
+
+    def acquire(self):
+        """
+        wait for a request slot
+
+        :return: start time of the request (pass it to release)
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, overloaded=False):
+        """
+        free a request slot and adapt the limit to the outcome of the request
+
+        :param started: return value of acquire
+        :param overloaded: the request failed because the server is overloaded, None - it failed for another reason
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                self._decrease(started, now)
+            elif overloaded is not None:
+                latency = now - started
+                self.min_latency = latency if self.min_latency is None else min(latency, self.min_latency * 1.01)
+                self.latency = latency if self.latency is None else \
+                    self.latency + self.smoothing * (latency - self.latency)
+                if self.latency > self.latency_tolerance * self.min_latency:
+                    self._decrease(started, now)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self, started, now):
+        # once per round trip: responses to the requests sent before the last decrease don't count
+        if started < self._decreased_at:
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self._decreased_at = now
+
+
+class ConcurrentUploader:
+    def __init__(self, base_url, user_id, concurrency=8, retries=3, backoff=0.5, timeout=10,
+                 batch_size=1, batch_bytes=0, fields=None, compression=None, compress_level=None,
+                 compress_threshold=1024, image_encoding=None, image_quality=DEFAULT_QUALITY, image_workers=None,
+                 connections=None, adaptive=True, latency_tolerance=2.0):
+        """
+        Upload snapshots with up to `concurrency` requests in flight.
+        The snapshots iterator is read only when a request slot is free (backpressure on the Reader).
+        With batch_size > 1 (or batch_bytes), consecutive snapshots are grouped and sent in a single
+        request to the batch endpoint (/snapshots/<user_id>?start=<snapshot_id>).
+
+        :param base_url: e.g. http://127.0.0.1:8000
+        :param concurrency: max number of snapshot requests in flight
+        :param retries: number of retries of a transient failure
+        :param backoff: base delay (seconds) of the jittered exponential backoff between retries
+        :param timeout: request timeout (seconds)
+        :param batch_size: max number of snapshots per request
+        :param batch_bytes: max size (bytes) of the serialized snapshots of a request, 0 - no limit.
+                            A single snapshot bigger than the limit is sent alone
+        :param fields: names of the snapshot fields to send (the others are pruned before serialization),
+                       None - send whole snapshots
+        :param compression: codec of the request bodies ("gzip" or "zstd", see cortex.compression),
+                            None - no compression. Use a codec advertised by the server
+        :param compress_level: compression level, None - the codec default
+        :param compress_threshold: bodies smaller than this (bytes) are sent uncompressed
+        :param image_encoding: re-encode raw color images to "jpeg" or "webp" before the upload
+                               (see cortex.imaging), None - send them as they are
+        :param image_quality: quality (1-100) of the re-encoded images
+        :param image_workers: number of processes re-encoding images, None - number of CPUs
+        :param connections: semaphore (e.g. multiprocessing.BoundedSemaphore) held during every request,
+                            caps the requests in flight across uploaders, None - no global cap
+        :param adaptive: adapt the number of requests in flight (up to concurrency) to the server load,
+                         see AdaptiveLimit. Otherwise it is fixed
+        :param latency_tolerance: latency increase (ratio to the baseline) considered as overload
+        """
+        self.base_url = base_url
+        self.user_id = user_id
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.batch_size = max(batch_size, 1)
+        self.batch_bytes = batch_bytes
+        self.fields = fields
+        self.compression = compression
+        self.compress_level = compress_level
+        self.compress_threshold = compress_threshold
+        self.image_encoding = image_encoding
+        self.image_quality = image_quality
+        self.image_workers = image_workers
+        self.connections = connections
+        self.limit = AdaptiveLimit(self.concurrency, 1 if adaptive else self.concurrency, latency_tolerance)
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def _session(self):
+        # requests.Session is not thread safe, each worker thread keeps its own
+        if not hasattr(self._local, "session"):
+            self._local.session = create_session(pool_size=1)
+            with self._lock:
+                self._sessions.append(self._local.session)
+        return self._local.session
+
+    @property
+    def batching(self):
+        return self.batch_size > 1 or self.batch_bytes > 0
+
+    def _serialized(self, snapshots):
+        """
+        serialize snapshots (in the calling thread - the reader may reuse the snapshot object)
+
+        :return: yields (snapshot_id, serialized snapshot)
+        """
+        for snapshot_id, snapshot in snapshots:
+            if isinstance(snapshot, (bytes, bytearray)):
+                yield snapshot_id, snapshot
+            elif self.fields is not None:
+                yield snapshot_id, serialize_fields(snapshot, self.fields)
+            else:
+                yield snapshot_id, serialize(snapshot)
+
+    def _reencoded(self, bodies):
+        """
+        re-encode the color images of serialized snapshots in a process pool, keeping their order.
+        Up to 2 snapshots per worker are being encoded ahead of the upload
+
+        :param bodies: iterable of (snapshot_id, serialized snapshot)
+        :return: yields (snapshot_id, serialized snapshot)
+        """
+        if self.image_encoding is None or (self.fields is not None and "color_image" not in self.fields):
+            yield from bodies
+            return
+        workers = self.image_workers or os.cpu_count() or 1
+        depth = 2 * workers
+        with ProcessPoolExecutor(workers) as pool:
+            pending = collections.deque()
+            for snapshot_id, body in bodies:
+                pending.append((snapshot_id, pool.submit(reencode_snapshot, bytes(body),
+                                                         self.image_encoding, self.image_quality)))
+                if len(pending) >= depth:
+                    snapshot_id, future = pending.popleft()
+                    yield snapshot_id, future.result()
+            while pending:
+                snapshot_id, future = pending.popleft()
+                yield snapshot_id, future.result()
+
+    def _requests(self, snapshots):
+        """
+        serialize snapshots and group them into requests
+
+        :return: yields ([snapshot_id, ...], url, body)
+        """
+        ids, bodies, size = [], [], 0
+        for snapshot_id, body in self._reencoded(self._serialized(snapshots)):
+            if not self.batching:
+                yield [snapshot_id], snapshot_url(self.base_url, self.user_id, snapshot_id), body
+                continue
+            if ids and (snapshot_id != ids[-1] + 1 or len(ids) >= self.batch_size or
+                        (self.batch_bytes and size + len(body) > self.batch_bytes)):
+                yield ids, batch_url(self.base_url, self.user_id, ids[0]), frame_records(bodies)
+                ids, bodies, size = [], [], 0
+            ids.append(snapshot_id)
+            bodies.append(body)
+            size += len(body)
+        if ids:
+            yield ids, batch_url(self.base_url, self.user_id, ids[0]), frame_records(bodies)
+
+    def encode(self, body):
+        """:return: (request body, headers) - the body is compressed if it is big enough"""
+        if self.compression is None or len(body) < self.compress_threshold:
+            return body, {}
+        return compress(body, self.compression, self.compress_level), {"Content-Encoding": self.compression}
+
+    def _post(self, url, body, headers):
+        """post within the limit of requests in flight, the outcome adapts the limit"""
+        started = self.limit.acquire()
+        try:
+            if self.connections is None:
+                r = post_snapshot(self._session(), url, body, headers, timeout=self.timeout)
+            else:
+                with self.connections:
+                    r = post_snapshot(self._session(), url, body, headers, timeout=self.timeout)
+        except UploadError as e:
+            self.limit.release(started, overloaded=e.overloaded if e.transient else None)
+            raise
+        except BaseException:
+            self.limit.release(started, overloaded=None)
+            raise
+        self.limit.release(started)
+        return r
+
+    def send(self, url, body):
+        """
+        post a serialized snapshot (or a batch), retrying transient failures
+        (compression runs here, in the worker threads)
+
+        :return: (size of the sent body, response)
+        :raise UploadError: when all the attempts failed
+        """
+        body, headers = self.encode(body)
+        attempt = 0
+        while True:
+            try:
+                r = self._post(url, body, headers)
+            except UploadError as e:
+                if not e.transient or attempt >= self.retries:
+                    raise
+                # the rejected request waits at least Retry-After, the others slow down with the limit
+                delay = retry_delay(attempt, self.backoff, e.retry_after)
+            else:
+                return len(body), r
+            time.sleep(delay)
+            attempt += 1
+
+    def upload(self, snapshots, checkpoint=None):
+        """
+        :param snapshots: iterable of (snapshot_id, snapshot object or serialized snapshot)
+        :param checkpoint: Checkpoint updated with the acknowledged snapshot ids
+        :return: UploadResult
+        """
+        result = UploadResult()
+        slots = threading.BoundedSemaphore(self.concurrency)
+
+        def done(snapshot_ids, future):
+            error = future.exception()
+            with self._lock:
+                if error is None:
+                    result.uploaded += len(snapshot_ids)
+                    result.sent_bytes += future.result()[0]
+                    if checkpoint is not None:
+                        checkpoint.ack(snapshot_ids)
+                else:
+                    result.failed.update({snapshot_id: str(error) for snapshot_id in snapshot_ids})
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for snapshot_ids, url, body in self._requests(snapshots):
+                    slots.acquire()
+                    future = pool.submit(self.send, url, body)
+                    future.add_done_callback(lambda f, ids=snapshot_ids: done(ids, f))
+        finally:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+            if checkpoint is not None:
+                checkpoint.save()
+        return result
@@ -0,0 +1,131 @@
+"""
+Content codecs of request bodies (HTTP Content-Encoding).
+gzip is always available, zstd requires the zstandard package.
+"""
+
+import gzip
+import io
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+CHUNK_SIZE = 1 << 20
+ZSTD_HEADER_SIZE_MAX = 18
+# gzip.BadGzipFile - not a gzip stream. Other OSErrors (spooling to disk, a client disconnecting) aren't corrupt data
+DECOMPRESSION_ERRORS = (zlib.error, EOFError, gzip.BadGzipFile) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def available_codecs():
+    """:return: names of the supported codecs, preferred first"""
+    return (["zstd"] if zstandard is not None else []) + ["gzip"]
+
+
+def compress(data, codec, level=None):
+    """
+    :param data: bytes-like object
+    :param codec: "gzip" or "zstd"
+    :param level: compression level, None - the codec default
+    :return: compressed bytes
+    """
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    if codec == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise CompressionError("unsupported codec: {}".format(codec))
+
+
+def decompress(data, codec, max_size=None):
+    """
+    :param data: compressed bytes-like object
+    :param codec: "gzip" or "zstd" (as in the Content-Encoding header)
+    :param max_size: max size of the decompressed data, None - no limit
+    :return: decompressed bytes
+    :raise CompressionError: for unsupported codecs, corrupt data or data exceeding max_size
+    """
+    reader = open_decompressed(io.BytesIO(data), codec)
+    chunks, size = [], 0
+    try:
+        for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise CompressionError("decompressed data exceeds {} bytes".format(max_size))
+            chunks.append(chunk)
+    except DECOMPRESSION_ERRORS as e:
+        raise CompressionError("corrupt {} data: {}".format(codec, e)) from None
+    return b"".join(chunks)
+
+
+def choose_codec(preferred, supported):
+    """
+    :param preferred: codec requested by the client, None - no compression
+    :param supported: codecs advertised by the server
+    :return: preferred if both sides support it, otherwise another common codec, None if there is none
+    """
+    if preferred is None:
+        return None
+    common = [codec for codec in available_codecs() if codec in supported]
+    if preferred in common:
+        return preferred
+    return common[0] if common else None
+
+
+class _Prefixed:
+    """file object reading prefix (bytes already read from fileobj) and then the rest of fileobj"""
+
+    def __init__(self, prefix, fileobj):
+        self._prefix = prefix
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fileobj.read(size)
+        if size is None or size < 0:
+            out, self._prefix = self._prefix + self._fileobj.read(), b""
+            return out
+        out, self._prefix = self._prefix[:size], self._prefix[size:]
+        return out
+
+
+class _ZstdReader:
+    """zstd decompressing file object that detects truncated frames"""
+
+    def __init__(self, fileobj):
+        header = fileobj.read(ZSTD_HEADER_SIZE_MAX)
+        # a truncated frame just ends early, it is detected with the size recorded in the frame header
+        try:
+            self._expected = zstandard.frame_content_size(header)
+        except zstandard.ZstdError:  # not a frame header, the decompressor reports it
+            self._expected = -1
+        self._size = 0
+        self._reader = zstandard.ZstdDecompressor().stream_reader(_Prefixed(header, fileobj))
+
+    def read(self, size=-1):
+        chunk = self._reader.read(size)
+        self._size += len(chunk)
+        if not chunk and size != 0 and 0 <= self._expected != self._size:
+            raise EOFError("zstd frame ended after {} of {} bytes".format(self._size, self._expected))
+        return chunk
+
+
+def open_decompressed(fileobj, codec):
+    """
+    :param fileobj: binary file object of compressed data (e.g. a request stream)
+    :param codec: "gzip" or "zstd" (as in the Content-Encoding header)
+    :return: binary file object of the decompressed data - read(size) decompresses no more than it returns,
+             so the caller bounds the memory (reads raise DECOMPRESSION_ERRORS on corrupt or truncated data)
+    :raise CompressionError: for unsupported codecs
+    """
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if codec == "zstd" and zstandard is not None:
+        return _ZstdReader(fileobj)
+    raise CompressionError("unsupported codec: {}".format(codec))
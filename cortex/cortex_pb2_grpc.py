@@ -1,3 +1,74 @@
 # Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
 import grpc
 
+from cortex import cortex_pb2 as cortex__pb2
+from google.protobuf import empty_pb2 as google_dot_protobuf_dot_empty__pb2
+
+
+class CortexStub(object):
+    """client streaming upload of the snapshots of a sample, over a single HTTP/2 stream.
+    request metadata: "user-id" and "start" - snapshot id of the first snapshot of the stream (default 1).
+    trailing metadata: "count" - number of snapshots that were accepted (also when the call fails)
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.UploadSample = channel.stream_unary(
+                '/Cortex/UploadSample',
+                request_serializer=cortex__pb2.Snapshot.SerializeToString,
+                response_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
+                )
+
+
+class CortexServicer(object):
+    """client streaming upload of the snapshots of a sample, over a single HTTP/2 stream.
+    request metadata: "user-id" and "start" - snapshot id of the first snapshot of the stream (default 1).
+    trailing metadata: "count" - number of snapshots that were accepted (also when the call fails)
+    """
+
+    def UploadSample(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file"""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_CortexServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'UploadSample': grpc.stream_unary_rpc_method_handler(
+                    servicer.UploadSample,
+                    request_deserializer=cortex__pb2.Snapshot.FromString,
+                    response_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'Cortex', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+ # This class is part of an EXPERIMENTAL API.
+class Cortex(object):
+    """client streaming upload of the snapshots of a sample, over a single HTTP/2 stream.
+    request metadata: "user-id" and "start" - snapshot id of the first snapshot of the stream (default 1).
+    trailing metadata: "count" - number of snapshots that were accepted (also when the call fails)
+    """
+
+    @staticmethod
+    def UploadSample(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(request_iterator, target, '/Cortex/UploadSample',
+            cortex__pb2.Snapshot.SerializeToString,
+            google_dot_protobuf_dot_empty__pb2.Empty.FromString,
+            options, channel_credentials,
+            call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -0,0 +1,108 @@
+"""
+Storage codecs of the depth images.
+The server stores a depth image with the codec of the depth_image parser in parsers.yaml:
+
+    depth_image:
+        path: /tmp/images/depth
+        codec: uint16   # float32 (default), float16, uint16 or npz
+        scale: 1000     # uint16 only: stored value = round(depth * scale), e.g. millimetres of depths in metres
+
+and describes it in the message (codec and scale of depth_image), load_depth decodes it back to float32.
+float16 halves the size (about 3 significant digits), uint16 halves it with a fixed resolution of 1 / scale
+and a range of [0, 65535 / scale] - depths out of it are clipped, NaN is stored as 0.
+npz is a compressed (deflate) float32 array, lossless.
+"""
+
+import io
+import numpy as np
+from cortex.segments import is_reference, read_data
+
+DEFAULT_CODEC = "float32"
+DEFAULT_SCALE = 1000
+DEPTH_DTYPE = np.dtype("<f4")
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+class DepthCodecError(ValueError):
+    pass
+
+
+def _encode_uint16(depth, scale):
+    scaled = np.nan_to_num(np.asarray(depth, dtype=np.float64) * scale, nan=0.0)
+    return np.clip(np.rint(scaled), 0, UINT16_MAX).astype("<u2").tobytes()
+
+
+def _encode_npz(depth, scale):
+    out = io.BytesIO()
+    np.savez_compressed(out, depth=np.asarray(depth, dtype=DEPTH_DTYPE))
+    return out.getvalue()
+
+
+def _decode_npz(data, scale):
+    with np.load(io.BytesIO(data)) as arrays:
+        return arrays["depth"].astype(DEPTH_DTYPE, copy=False).ravel()
+
+
+# codec: (encode(depth, scale) -> bytes-like, decode(data, scale) -> flat float32 array)
+codecs = {
+    "float32": (lambda depth, scale: np.ascontiguousarray(depth, dtype=DEPTH_DTYPE),
+                lambda data, scale: np.frombuffer(data, dtype=DEPTH_DTYPE)),
+    "float16": (lambda depth, scale: np.asarray(depth).astype("<f2").tobytes(),
+                lambda data, scale: np.frombuffer(data, dtype="<f2").astype(DEPTH_DTYPE)),
+    "uint16": (_encode_uint16,
+               lambda data, scale: np.frombuffer(data, dtype="<u2").astype(DEPTH_DTYPE) / DEPTH_DTYPE.type(scale)),
+    "npz": (_encode_npz, _decode_npz),
+}
+
+
+def depth_codec(config):
+    """
+    :param config: options of the depth_image parser in parsers.yaml (None - no options)
+    :return: (codec, scale)
+    :raise DepthCodecError: unknown codec or invalid scale
+    """
+    config = config or {}
+    codec = config.get("codec", DEFAULT_CODEC)
+    if codec not in codecs:
+        raise DepthCodecError("unknown depth codec: {} (expected one of {})".format(codec, ", ".join(codecs)))
+    scale = config.get("scale", DEFAULT_SCALE)
+    if not isinstance(scale, (int, float)) or scale <= 0:
+        raise DepthCodecError("depth scale should be a positive number, got {}".format(scale))
+    return codec, scale
+
+
+def encode_depth(depth, codec=DEFAULT_CODEC, scale=DEFAULT_SCALE):
+    """
+    :param depth: float array
+    :return: the stored bytes-like data
+    """
+    encode, _ = codecs[codec]
+    return encode(depth, scale)
+
+
+def decode_depth(data, codec=DEFAULT_CODEC, scale=DEFAULT_SCALE):
+    """
+    :param data: stored data (bytes-like)
+    :return: flat float32 array (a view over data for float32)
+    """
+    if codec not in codecs:
+        raise DepthCodecError("unknown depth codec: {}".format(codec))
+    _, decode = codecs[codec]
+    return decode(data, scale)
+
+
+def load_depth(depth_image):
+    """
+    :param depth_image: depth_image of a snapshot message (data_path, width, height and codec, scale)
+    :return: float32 array shaped (height, width) - flat if the size doesn't match
+    """
+    data_path = depth_image["data_path"]
+    if is_reference(data_path):
+        depth = decode_depth(read_data(data_path), depth_image.get("codec", DEFAULT_CODEC),
+                             depth_image.get("scale", DEFAULT_SCALE))
+    else:  # a .npy file, saved before segments
+        depth = np.load(data_path, mmap_mode="r").astype(DEPTH_DTYPE, copy=False).ravel()
+    width, height = int(depth_image.get("width", 0)), int(depth_image.get("height", 0))
+    if depth.size == width * height:
+        return depth.reshape(height, width)
+    return depth
@@ -0,0 +1,360 @@
+"""
+Sample container formats.
+
+A sample is a stream of length-delimited records (the user header followed by the snapshots).
+The stream can be stored:
+    gzip - the original format (.gz). New samples are written as a gzip member per GZIP_MEMBER_SIZE
+           bytes of records, so that they can be entered at any member (see cortex.index)
+    zstd - zstd frames (.zst), several times faster to decompress than gzip.
+           requires the zstandard package
+    raw  - uncompressed (.sample), read through mmap: records are zero-copy slices of the file
+The format of an existing sample is detected by its magic number, the format of a new sample
+is chosen by its extension (see SampleWriter).
+"""
+
+import gzip
+import mmap
+import os
+import struct
+import zlib
+from cortex.wire import iter_fields, WireError, VARINT, LENGTH_DELIMITED
+
+try:
+    import zstandard
+except ImportError:  # optional dependency, needed only for zstd samples
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+HEADER_SIZE = struct.calcsize("I")  # record length prefix
+CHUNK_SIZE = 1024 * 1024
+GZIP_MEMBER_SIZE = 4 * 1024 * 1024  # uncompressed bytes per gzip member of a new sample
+MAX_USER_SIZE = 64 * 1024  # a user header is a few bytes, a bigger first record isn't one
+# wire types of the User fields (see cortex.proto) - a raw sample starts with a serialized User
+USER_FIELDS = {1: VARINT, 2: LENGTH_DELIMITED, 3: VARINT, 4: VARINT}
+# errors raised by a damaged compressed stream
+DECODE_ERRORS = (zlib.error, EOFError, gzip.BadGzipFile) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class FormatError(NameError):
+    pass
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise FormatError("zstd samples require the zstandard package (pip install zstandard)")
+
+
+class MappedFile:
+    """read-only file object over a memory mapped file, read returns zero-copy memoryview slices"""
+
+    def __init__(self, filename, offset=0):
+        self._file = open(filename, "rb")
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        else:  # empty files can't be mapped
+            self._map = None
+            self._view = memoryview(b"")
+        self._pos = offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self._view.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            # records are still referenced by the caller, the map is closed when they are released
+            pass
+        self._file.close()
+        self._file = None
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset):
+        self._pos = offset
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos:end]
+        self._pos = max(end, self._pos)
+        return data
+
+
+class _SkipReader:
+    """wraps a forward-only stream (e.g. zstd), read returns exactly size bytes unless at the end"""
+
+    def __init__(self, stream, fileobj, offset=0):
+        self._stream = stream
+        self._file = fileobj
+        self._pos = 0
+        while self._pos < offset:
+            if not self.read(min(CHUNK_SIZE, offset - self._pos)):
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._stream.close()
+            self._file.close()
+            self._file = None
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._stream.read()
+        else:
+            parts = []
+            remaining = size
+            while remaining > 0:
+                part = self._stream.read(remaining)
+                if not part:
+                    break
+                parts.append(part)
+                remaining -= len(part)
+            data = b"".join(parts)
+        self._pos += len(data)
+        return data
+
+
+class GzipMembersWriter:
+    """
+    gzip writer starting a new member every member_size bytes of input.
+    A gzip reader reads the members as a single stream, and decompression can start at any member
+    with no decompressor state - the sample index saves the member offsets (see cortex.index)
+    """
+
+    def __init__(self, filename, level=9, member_size=GZIP_MEMBER_SIZE):
+        self._file = open(filename, "wb")
+        self.level = level
+        self.member_size = member_size
+        self._member = None
+        self._member_input = 0  # bytes written to the current member
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, data):
+        if self._member is None or self._member_input >= self.member_size:
+            self._end_member()
+            self._member = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=self.level)
+        self._member_input += len(data)
+        return self._member.write(data)
+
+    def _end_member(self):
+        if self._member is not None:
+            self._member.close()  # writes the trailer, the file stays open
+            self._member = None
+            self._member_input = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._member is None:  # an empty sample is still a gzip file
+            self._member = gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=self.level)
+        self._end_member()
+        self._file.close()
+        self._file = None
+
+
+class GzipFormat:
+    name = "gzip"
+    suffix = ".gz"
+    magic = GZIP_MAGIC
+    random_access = False  # seeking relies on the restore points of the sample index
+
+    def open(self, filename, offset=0):
+        f = gzip.open(filename, "rb")
+        if offset:
+            f.seek(offset)
+        return f
+
+    def create(self, filename, level=None):
+        return GzipMembersWriter(filename, 9 if level is None else level)
+
+
+class ZstdFormat:
+    name = "zstd"
+    suffix = ".zst"
+    magic = ZSTD_MAGIC
+    random_access = False  # zstd streams are read from the start
+
+    def open(self, filename, offset=0):
+        _require_zstandard()
+        f = open(filename, "rb")
+        stream = zstandard.ZstdDecompressor().stream_reader(f, read_size=CHUNK_SIZE, read_across_frames=True)
+        return _SkipReader(stream, f, offset)
+
+    def create(self, filename, level=None):
+        _require_zstandard()
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return compressor.stream_writer(open(filename, "wb"), closefd=True)
+
+
+class RawFormat:
+    name = "raw"
+    suffix = ".sample"
+    magic = b""
+    random_access = True
+
+    def open(self, filename, offset=0):
+        return MappedFile(filename, offset)
+
+    def create(self, filename, level=None):
+        return open(filename, "wb")
+
+
+formats = {"gzip": GzipFormat(), "zstd": ZstdFormat(), "raw": RawFormat()}
+
+
+def frame_records(msgs):
+    """
+    :param msgs: iterable of serialized messages
+    :return: the messages framed as in a sample (each prefixed by its length)
+    """
+    return b"".join(struct.pack("I", len(msg)) + bytes(msg) for msg in msgs)
+
+
+def iter_records(buf):
+    """
+    :param buf: framed messages (see frame_records)
+    :return: yields the messages as zero-copy memoryview slices of buf
+    :raise ValueError: if the last record is truncated
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        if pos + HEADER_SIZE > len(view):
+            raise ValueError("truncated length prefix at offset {}".format(pos))
+        length, = struct.unpack_from("I", view, pos)
+        pos += HEADER_SIZE
+        if pos + length > len(view):
+            raise ValueError("truncated record at offset {} (expected {} bytes, got {})".format(
+                pos, length, len(view) - pos))
+        yield view[pos:pos + length]
+        pos += length
+
+
+def read_record(fileobj):
+    """
+    :param fileobj: file object of a sample positioned at a length prefix
+    :return: the next record, None at the end of the file (or if the record is truncated)
+    """
+    header = fileobj.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return None
+    length, = struct.unpack("I", header)
+    record = fileobj.read(length)
+    if len(record) < length:
+        return None
+    return record
+
+
+def _is_user(record):
+    """:return: True if record is a serialized User - known fields of the expected wire types only"""
+    try:
+        for number, wire_type, _, start, end in iter_fields(record):
+            if USER_FIELDS.get(number) != wire_type:
+                return False
+            if wire_type == LENGTH_DELIMITED:  # username
+                bytes(record[start:end]).decode("utf-8")
+    except (WireError, UnicodeDecodeError):
+        return False
+    return True
+
+
+def _starts_with_user(f, size):
+    """:return: True if the file starts with a length prefixed User, as a raw sample does"""
+    header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        return False
+    length, = struct.unpack("I", header)
+    if length > MAX_USER_SIZE or HEADER_SIZE + length > size:
+        return False
+    return _is_user(f.read(length))
+
+
+def detect_format(filename):
+    """
+    :param filename: path to an existing sample
+    :return: format object, detected by the magic number of the file
+             (a raw sample has none, its first record has to be a user)
+    :raise FormatError: the file isn't a sample of a supported format
+    """
+    with open(filename, "rb") as f:
+        head = f.read(max(len(fmt.magic) for fmt in formats.values()))
+        for fmt in formats.values():
+            if fmt.magic and head.startswith(fmt.magic):
+                return fmt
+        f.seek(0)
+        if _starts_with_user(f, os.fstat(f.fileno()).st_size):
+            return formats["raw"]
+    raise FormatError("Unsupported sample format: '{}' is neither a gzip, zstd nor raw sample".format(filename))
+
+
+def format_by_suffix(filename):
+    """:return: format object chosen by the file extension (raw for unknown extensions)"""
+    for fmt in formats.values():
+        if fmt.magic and filename.endswith(fmt.suffix):
+            return fmt
+    return formats["raw"]
+
+
+def find_format(name):
+    if name not in formats:
+        raise FormatError("Unknown sample format: '{}'. Expected one of {}".format(name, ", ".join(formats)))
+    return formats[name]
+
+
+class SampleWriter:
+    def __init__(self, filename, format=None, level=None):
+        """
+        :param filename: path to the new sample
+        :param format: "gzip", "zstd" or "raw". By default, chosen by the extension of filename
+        :param level: compression level (ignored for raw samples)
+        """
+        self.filename = filename
+        self.format = find_format(format) if format else format_by_suffix(filename)
+        self.__file_object = self.format.create(filename, level)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.__file_object:
+            self.__file_object.close()
+            self.__file_object = None
+
+    def write_msg(self, msg):
+        """:param msg: serialized message (bytes-like)"""
+        self.__file_object.write(struct.pack("I", len(msg)))
+        self.__file_object.write(msg)
+
+    def write_user(self, user):
+        self.write_msg(user if isinstance(user, (bytes, bytearray, memoryview)) else user.SerializeToString())
+
+    def write_snapshot(self, snapshot):
+        self.write_msg(snapshot if isinstance(snapshot, (bytes, bytearray, memoryview))
+                       else snapshot.SerializeToString())
@@ -0,0 +1,72 @@
+"""
+Encoding of the color images of snapshots.
+ColorImage.data holds either raw RGB bytes (width x height x 3) or an encoded image (JPEG, WebP).
+The encoding isn't part of the message, it is detected by the magic bytes of the data.
+"""
+
+import io
+from PIL import Image
+from cortex.arrays import SNAPSHOT_COLOR_IMAGE, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DATA, color_array
+from cortex.wire import scan_fields, encode_field, WireError, VARINT, LENGTH_DELIMITED
+
+RAW_ENCODING = "raw"
+# encoding: PIL format name
+IMAGE_ENCODINGS = {"jpeg": "JPEG", "webp": "WEBP"}
+DEFAULT_QUALITY = 90
+
+
+def detect_encoding(data, width=0, height=0):
+    """
+    :param data: ColorImage.data (bytes-like)
+    :param width: ColorImage.width, if known...
+    :param height: ...and height: data of width x height x 3 bytes is raw whatever its first bytes are
+    :return: "jpeg", "webp" or "raw"
+    """
+    data = memoryview(data).cast("B")
+    if width and height and len(data) == width * height * 3:
+        return RAW_ENCODING
+    head = bytes(data[:12])
+    if head[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return RAW_ENCODING
+
+
+def encode_image(pixels, encoding, quality=DEFAULT_QUALITY):
+    """
+    :param pixels: uint8 array shaped (height, width, 3)
+    :param encoding: "jpeg" or "webp"
+    :param quality: 1-100
+    :return: encoded image bytes
+    """
+    out = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(out, IMAGE_ENCODINGS[encoding], quality=quality)
+    return out.getvalue()
+
+
+def reencode_snapshot(raw, encoding, quality=DEFAULT_QUALITY):
+    """
+    replace the raw RGB color image of a serialized snapshot with an encoded one.
+    The other fields are copied as they are (the snapshot isn't parsed)
+
+    :param raw: serialized snapshot (bytes-like)
+    :param encoding: "jpeg" or "webp"
+    :param quality: 1-100
+    :return: the new serialized snapshot, raw itself if there is no raw color image
+             (missing, already encoded or its size doesn't match width x height)
+    """
+    try:
+        spans = scan_fields(raw)
+        if len(spans.get(SNAPSHOT_COLOR_IMAGE, [])) != 1:
+            return raw
+        pixels = color_array(raw, spans)
+    except (WireError, ValueError):
+        return raw
+    if pixels is None or pixels.ndim != 3:
+        return raw
+    height, width, _ = pixels.shape
+    image = (encode_field(IMAGE_WIDTH, VARINT, width) + encode_field(IMAGE_HEIGHT, VARINT, height) +
+             encode_field(IMAGE_DATA, LENGTH_DELIMITED, encode_image(pixels, encoding, quality)))
+    _, field_start, _, value_end = spans[SNAPSHOT_COLOR_IMAGE][0]
+    return b"".join((raw[:field_start], encode_field(SNAPSHOT_COLOR_IMAGE, LENGTH_DELIMITED, image), raw[value_end:]))
@@ -0,0 +1,399 @@
+"""
+Seekable index for samples.
+
+A sample is a stream of length-delimited records: the user header followed by
+the snapshots, each record prefixed by its length (struct "I"), stored in one of the
+container formats of cortex.formats.
+A single pass over the stream collects the uncompressed offset and length of every
+record and, for gzip samples, restore points - offsets a decompression can start from:
+    - the start of every gzip member. SampleWriter starts a member every GZIP_MEMBER_SIZE bytes
+      (see cortex.formats), a decompression starts there from scratch
+    - every `spacing` bytes of output within a member, a copy of the decompressor together with
+      the compressed offset it has consumed so far
+Starting a decompression from the nearest restore point makes seeking to any record
+cost at most `spacing` (or GZIP_MEMBER_SIZE) bytes of inflate instead of the whole prefix of the file.
+
+Raw samples are random access by themselves and zstd samples are read from their start.
+The record table and the member restore points are saved to a sidecar file (<sample>.idx),
+so that they are built only once and a new process seeks as fast as the one that built them.
+zlib decompressor states can't be serialized, so the restore points within a member live in memory only:
+they are collected by the indexing pass and by every cursor that inflates the file. A single member gzip
+sample (not written by SampleWriter, convert it with convert_sample) is inflated from its start by the first
+seek of every process.
+"""
+
+import os
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left
+from cortex.formats import detect_format, CHUNK_SIZE as READ_SIZE, DECODE_ERRORS, GZIP_MAGIC
+
+
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"CTXIDX02"
+DEFAULT_SPACING = 4 * 1024 * 1024  # bytes of uncompressed data between restore points
+CHUNK_SIZE = 64 * 1024  # compressed bytes fed to the decompressor at once
+HEADER_SIZE = struct.calcsize("I")  # record length prefix
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# magic, sample size, sample mtime, user offset, user length, uncompressed size, records count, error length,
+# member restore points count
+_SIDECAR_HEADER = struct.Struct("<8sQqQIQQIQ")
+
+
+class SampleIndexError(Exception):
+    pass
+
+
+class RestorePoint:
+    def __init__(self, uoffset, coffset, decompressor=None):
+        self.uoffset = uoffset  # uncompressed offset of the next output byte
+        self.coffset = coffset  # compressed offset of the next input byte
+        self.decompressor = decompressor  # None - the start of a gzip member
+
+    @property
+    def is_member(self):
+        """True if the point is the start of a gzip member - it is saved to the sidecar"""
+        return self.decompressor is None
+
+    def new_decompressor(self):
+        return zlib.decompressobj(GZIP_WBITS) if self.decompressor is None else self.decompressor.copy()
+
+
+def _inflate(fileobj, point, on_point=None, spacing=DEFAULT_SPACING):
+    """
+    Generator of uncompressed chunks starting at the supplied restore point.
+    Multi member gzip files are supported. zlib.error is raised on corrupt data and
+    EOFError when the compressed stream ends unexpectedly.
+
+    :param fileobj: raw (compressed) file object
+    :param point: RestorePoint to start from
+    :param on_point: callback that receives new restore points (every gzip member and every `spacing` bytes)
+    :param spacing: distance between restore points in uncompressed bytes
+    :return: yields (uncompressed offset, chunk)
+    """
+    decompressor = point.new_decompressor()
+    uoffset, coffset = point.uoffset, point.coffset
+    next_point = (uoffset // spacing + 1) * spacing
+    fileobj.seek(coffset)
+    while True:
+        data = fileobj.read(CHUNK_SIZE)
+        if not data:
+            if not decompressor.eof:
+                raise EOFError("compressed stream ended before the end-of-stream marker was reached")
+            return
+        coffset += len(data)
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield uoffset, chunk
+                uoffset += len(chunk)
+            if decompressor.eof:
+                # next gzip member (or trailing garbage which will raise zlib.error)
+                data = decompressor.unused_data
+                if data.strip(b"\x00"):
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    if on_point is not None and data.startswith(GZIP_MAGIC):
+                        on_point(RestorePoint(uoffset, coffset - len(data)))
+                        next_point = (uoffset // spacing + 1) * spacing
+                else:
+                    data = b""
+            else:
+                data = b""
+        if on_point is not None and uoffset >= next_point and not decompressor.eof:
+            on_point(RestorePoint(uoffset, coffset, decompressor.copy()))
+            next_point = (uoffset // spacing + 1) * spacing
+
+
+class GzipCursor:
+    """read-only file object over the uncompressed stream, started at a restore point"""
+
+    def __init__(self, index, offset):
+        self.index = index
+        self._file = open(index.filename, "rb")
+        point = index.restore_point(offset)
+        self._chunks = _inflate(self._file, point, index.add_restore_point, index.spacing)
+        self._offset = point.uoffset  # uncompressed offset of self._buf[0]
+        self._buf = b""
+        self._pos = 0
+        self._skip(offset - point.uoffset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def tell(self):
+        return self._offset + self._pos
+
+    def _fill(self):
+        try:
+            _, chunk = next(self._chunks)
+        except StopIteration:
+            return False
+        self._offset += self._pos
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip(self, size):
+        while size > 0:
+            available = len(self._buf) - self._pos
+            if available >= size:
+                self._pos += size
+                return
+            size -= available
+            self._pos = len(self._buf)
+            if not self._fill():
+                return
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self._buf) - self._pos
+        while len(self._buf) - self._pos < size:
+            if not self._fill():
+                break
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+class SampleIndex:
+    def __init__(self, filename, user_offset, user_length, offsets, lengths, size,
+                 error="", spacing=DEFAULT_SPACING, stat=None, fmt=None, members=()):
+        """
+        :param filename: path to the sample
+        :param user_offset: uncompressed offset of the user message (after its length prefix)
+        :param user_length: user message length
+        :param offsets: array of snapshot offsets (after their length prefix)
+        :param lengths: array of snapshot lengths
+        :param size: uncompressed size of the sample
+        :param error: description of a truncated/corrupt tail, empty if the sample is intact
+        :param spacing: distance between restore points in uncompressed bytes
+        :param stat: os.stat_result of the sample when the index was built
+        :param fmt: container format of the sample (see cortex.formats), detected if not supplied
+        :param members: (uncompressed offset, compressed offset) of the gzip members, as saved to the sidecar
+        """
+        self.filename = filename
+        self.format = fmt if fmt is not None else detect_format(filename)
+        self.user_offset = user_offset
+        self.user_length = user_length
+        self.offsets = offsets
+        self.lengths = lengths
+        self.size = size
+        self.error = error
+        self.spacing = spacing
+        self.stat = stat if stat is not None else os.stat(filename)
+        self._set_members(members)
+
+    def _set_members(self, members):
+        # [(uncompressed offset, RestorePoint)] sorted - added to by the threads inflating the sample
+        # (see cortex.prefetch) while others look them up
+        self._points = [(0, RestorePoint(0, 0))]
+        self._points_lock = threading.Lock()
+        for uoffset, coffset in members:
+            self.add_restore_point(RestorePoint(uoffset, coffset))
+
+    @property
+    def members(self):
+        """:return: [(uncompressed offset, compressed offset)] of the gzip members (but the first one)"""
+        with self._points_lock:
+            return [(point.uoffset, point.coffset) for _, point in self._points if point.is_member and point.uoffset]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        # decompressor states can't be pickled, only the member restore points are kept
+        state = self.__dict__.copy()
+        state["_points"] = self.members
+        del state["_points_lock"]
+        return state
+
+    def __setstate__(self, state):
+        members = state.pop("_points")
+        self.__dict__.update(state)
+        self._set_members(members)
+
+    @property
+    def is_damaged(self):
+        return self.error != ""
+
+    def record(self, i):
+        """
+        :param i: snapshot index
+        :return: (offset of the length prefix, length of the snapshot message)
+        """
+        return self.offsets[i] - HEADER_SIZE, self.lengths[i]
+
+    def restore_point(self, offset):
+        """:return: the last restore point at or before the uncompressed offset"""
+        with self._points_lock:
+            # (offset + 1,) sorts after every point at offset - a shorter tuple is smaller
+            return self._points[bisect_left(self._points, (offset + 1,)) - 1][1]
+
+    def covers(self, offset):
+        """:return: True if the offset can be reached without reading the sample from its start"""
+        if self.format.random_access:
+            return True
+        if self.format.name != "gzip":
+            return False
+        # a restore point close enough to the offset was already collected
+        return offset - self.restore_point(offset).uoffset <= 2 * self.spacing
+
+    def add_restore_point(self, point):
+        with self._points_lock:
+            i = bisect_left(self._points, (point.uoffset + 1,))
+            if self._points[i - 1][0] == point.uoffset:
+                if point.is_member:  # needs no decompressor state, and is saved
+                    self._points[i - 1] = (point.uoffset, point)
+            else:
+                self._points.insert(i, (point.uoffset, point))
+
+    def open_at(self, offset):
+        """
+        :param offset: uncompressed offset
+        :return: read-only file object positioned at offset
+        """
+        if self.format.name == "gzip":
+            return GzipCursor(self, offset)
+        return self.format.open(self.filename, offset)
+
+    def save(self, path=None):
+        """
+        save the record table and the member restore points to the sidecar file
+        (restore points within a member are kept in memory only)
+        """
+        path = path or self.filename + INDEX_SUFFIX
+        error = self.error.encode()
+        members = self.members
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_SIDECAR_HEADER.pack(INDEX_MAGIC, self.stat.st_size, self.stat.st_mtime_ns,
+                                         self.user_offset, self.user_length, self.size,
+                                         len(self.offsets), len(error), len(members)))
+            f.write(error)
+            f.write(array("Q", self.offsets).tobytes())
+            f.write(array("I", self.lengths).tobytes())
+            f.write(array("Q", (offset for member in members for offset in member)).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, filename, path=None, spacing=DEFAULT_SPACING):
+        """
+        load the sidecar index of filename
+
+        :return: SampleIndex, or None if there is no sidecar or it is stale
+        """
+        path = path or filename + INDEX_SUFFIX
+        stat = os.stat(filename)
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_SIDECAR_HEADER.size)
+                if len(header) != _SIDECAR_HEADER.size:
+                    return None
+                magic, sample_size, mtime, user_offset, user_length, size, count, error_len, members_count = \
+                    _SIDECAR_HEADER.unpack(header)
+                if magic != INDEX_MAGIC or sample_size != stat.st_size or mtime != stat.st_mtime_ns:
+                    return None
+                error = f.read(error_len).decode()
+                offsets, lengths, members = array("Q"), array("I"), array("Q")
+                offsets.fromfile(f, count)
+                lengths.fromfile(f, count)
+                members.fromfile(f, 2 * members_count)
+        except (OSError, EOFError, UnicodeDecodeError):
+            return None
+        return cls(filename, user_offset, user_length, offsets, lengths, size, error, spacing, stat,
+                   members=zip(members[::2], members[1::2]))
+
+
+def _chunks(index, fileobj):
+    """:return: yields (uncompressed offset, chunk) of the whole sample"""
+    if index.format.name == "gzip":
+        yield from _inflate(fileobj, index.restore_point(0), index.add_restore_point, index.spacing)
+        return
+    uoffset = 0
+    with index.format.open(index.filename) as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                return
+            yield uoffset, chunk
+            uoffset += len(chunk)
+
+
+def build_index(filename, spacing=DEFAULT_SPACING):
+    """
+    Build an index with a single pass over the sample. Records are framed by their length
+    prefix only, no protobuf is parsed. A truncated or corrupt tail is reported in index.error
+    and the damaged records are left out of the index.
+
+    :param filename: path to the sample
+    :param spacing: distance between restore points in uncompressed bytes
+    :return: SampleIndex
+    """
+    stat = os.stat(filename)
+    index = SampleIndex(filename, 0, 0, array("Q"), array("I"), 0, spacing=spacing, stat=stat)
+    records = []  # (offset, length) including the user header
+    next_record = 0  # uncompressed offset of the next length prefix
+    prefix = b""
+    end = 0
+    with open(filename, "rb") as f:
+        try:
+            for uoffset, chunk in _chunks(index, f):
+                end = uoffset + len(chunk)
+                while next_record < end:
+                    i = next_record - uoffset + len(prefix)
+                    prefix += chunk[i:i + HEADER_SIZE - len(prefix)]
+                    if len(prefix) < HEADER_SIZE:
+                        break
+                    length, = struct.unpack("I", prefix)
+                    records.append((next_record + HEADER_SIZE, length))
+                    next_record += HEADER_SIZE + length
+                    prefix = b""
+        except DECODE_ERRORS as e:
+            index.error = "damaged compressed stream after uncompressed offset {}: {}".format(end, e)
+
+    if prefix:
+        index.error = index.error or "truncated length prefix at offset {}".format(next_record)
+    if records and records[-1][0] + records[-1][1] > end:
+        offset, length = records.pop()
+        index.error = index.error or "truncated record at offset {} (expected {} bytes, got {})".format(
+            offset, length, end - offset)
+    if not records:
+        raise SampleIndexError("no user header was found in {}. {}".format(filename, index.error))
+
+    index.user_offset, index.user_length = records[0]
+    index.offsets = array("Q", (offset for offset, _ in records[1:]))
+    index.lengths = array("I", (length for _, length in records[1:]))
+    index.size = end
+    return index
+
+
+def get_index(filename, spacing=DEFAULT_SPACING, rebuild=False):
+    """
+    load the sidecar index of the sample, or build it (and try to save it) if it is missing or stale
+
+    :param filename: path to the sample
+    :param spacing: distance between restore points in uncompressed bytes
+    :param rebuild: ignore an existing sidecar file
+    :return: SampleIndex
+    """
+    index = None if rebuild else SampleIndex.load(filename, spacing=spacing)
+    if index is None:
+        index = build_index(filename, spacing)
+        try:
+            index.save()
+        except OSError:  # read only directory, the index is still usable in memory
+            pass
+    return index
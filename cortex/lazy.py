@@ -0,0 +1,97 @@
+"""
+Lazy snapshot view.
+Only the positions of the top-level fields of a serialized Snapshot are scanned,
+a field is decoded on first access. Image payloads are never touched unless they are used.
+"""
+
+import cortex.cortex_pb2 as cortex_pb2
+from cortex.arrays import snapshot_arrays
+from cortex.wire import scan_fields, decode_scalar
+
+
+_DESCRIPTOR = cortex_pb2.Snapshot.DESCRIPTOR
+SNAPSHOT_FIELDS = tuple(field.name for field in _DESCRIPTOR.fields)
+# fields kept regardless of the selection - they identify the snapshot and cost nothing to decode
+ALWAYS_SELECTED = ("datetime",)
+_MESSAGE_TYPES = {field.name: getattr(cortex_pb2, field.message_type.name)
+                  for field in _DESCRIPTOR.fields if field.message_type is not None}
+
+
+class LazySnapshot:
+    """
+    read-only stand-in for cortex_pb2.Snapshot (attributes, HasField, ListFields and SerializeToString)
+    over a serialized snapshot. Decoded submessages are cached, changing them doesn't change the view.
+    """
+
+    def __init__(self, raw, fields=None):
+        """
+        :param raw: serialized snapshot (bytes-like)
+        :param fields: names of the fields to expose, None for all of them.
+                       Other fields behave as if they were not set.
+        """
+        if fields is None:
+            fields = SNAPSHOT_FIELDS
+        else:
+            unknown = set(fields) - set(SNAPSHOT_FIELDS)
+            if unknown:
+                raise ValueError("unknown snapshot fields: {}".format(", ".join(sorted(unknown))))
+            fields = tuple(name for name in SNAPSHOT_FIELDS if name in fields or name in ALWAYS_SELECTED)
+        self.raw = raw
+        self.fields = fields
+        self._spans = {}  # field name: [(wire type, field start, value start, value end), ...]
+        self._values = {}
+        for number, spans in scan_fields(raw).items():
+            field = _DESCRIPTOR.fields_by_number.get(number)
+            if field is not None and field.name in fields:
+                self._spans[field.name] = spans
+
+    def __getattr__(self, name):
+        # called only when regular attribute lookup fails, i.e. for snapshot fields
+        field = _DESCRIPTOR.fields_by_name.get(name)
+        if field is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        if name not in self._values:
+            self._values[name] = self._decode(field)
+        return self._values[name]
+
+    def _decode(self, field):
+        spans = self._spans.get(field.name, [])
+        if field.name in _MESSAGE_TYPES:
+            msg = _MESSAGE_TYPES[field.name]()
+            for _, _, start, end in spans:  # repeated occurrences of a submessage are merged
+                msg.MergeFromString(bytes(self.raw[start:end]))
+            return msg
+        if not spans:
+            return field.default_value
+        wire_type, _, start, _ = spans[-1]
+        return decode_scalar(self.raw, wire_type, start)
+
+    def HasField(self, name):
+        if name not in _MESSAGE_TYPES:
+            raise ValueError('Protocol message has no singular message field "{}"'.format(name))
+        return name in self._spans
+
+    def ListFields(self):
+        """:return: [(field descriptor, value), ...] of the set fields, ordered by field number"""
+        listed = []
+        for field in _DESCRIPTOR.fields:
+            if field.name in self._spans:
+                value = getattr(self, field.name)
+                if field.name in _MESSAGE_TYPES or value != field.default_value:
+                    listed.append((field, value))
+        return listed
+
+    def SerializeToString(self):
+        """:return: serialized snapshot including the selected fields only"""
+        if len(self.fields) == len(SNAPSHOT_FIELDS):
+            return bytes(self.raw)
+        spans = sorted((span for spans in self._spans.values() for span in spans), key=lambda span: span[1])
+        return b"".join(bytes(self.raw[field_start:end]) for _, field_start, _, end in spans)
+
+    def arrays(self):
+        """:return: SnapshotArrays(depth, color) - zero-copy views over the raw images (see cortex.arrays)"""
+        return snapshot_arrays(self.raw)
+
+    def to_snapshot(self):
+        """:return: cortex_pb2.Snapshot holding the selected fields"""
+        return cortex_pb2.Snapshot.FromString(self.SerializeToString())
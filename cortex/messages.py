@@ -0,0 +1,179 @@
+"""
+Messages published by the server for the parsers.
+A snapshot message is built field by field from the serialized snapshot with the wire scanner
+(cortex.wire): the image payloads are saved to disk and referenced by data_path, they are never
+decoded into the message. Its layout is the one of MessageToDict (proto field names, default values
+included, uint64 as a string, see https://developers.google.com/protocol-buffers/docs/proto3#json)
+so that the JSON form is unchanged.
+
+A message is encoded as JSON (the default, for compatibility) or msgpack, consumers decode it
+according to its content type.
+"""
+
+import json
+import struct
+from cortex.arrays import (SNAPSHOT_DATETIME, SNAPSHOT_POSE, SNAPSHOT_COLOR_IMAGE, SNAPSHOT_DEPTH_IMAGE,
+                           SNAPSHOT_FEELINGS, POSE_TRANSLATION, POSE_ROTATION, IMAGE_WIDTH, IMAGE_HEIGHT, IMAGE_DATA)
+from cortex.imaging import detect_encoding
+from cortex.wire import iter_fields, scan_fields, decode_scalar, WireError, VARINT, FIXED64, FIXED32
+
+try:
+    import msgpack
+except ImportError:  # msgpack messages are optional
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+DEFAULT_FORMAT = "json"
+
+# field number: name, in field number order
+TRANSLATION_FIELDS = ("x", "y", "z")
+ROTATION_FIELDS = ("x", "y", "z", "w")
+FEELINGS_FIELDS = ("hunger", "thirst", "exhaustion", "happiness")
+
+
+class MessageError(ValueError):
+    pass
+
+
+def _shortest_float(value):
+    """:return: the shortest decimal of a float32 value (as MessageToDict renders float fields)"""
+    packed = struct.pack("<f", value)
+    for precision in range(6, 10):
+        rounded = float("{0:.{1}g}".format(value, precision))
+        if struct.pack("<f", rounded) == packed:
+            return rounded
+    return value
+
+
+def _fixed_fields(raw, start, end, names, wire_type, fmt):
+    """:return: {name: value} of fields 1..len(names) of the message raw[start:end], missing ones are 0.0"""
+    values = dict.fromkeys(names, 0.0)
+    for number, field_wire_type, _, value_start, _ in iter_fields(raw, start, end):
+        if field_wire_type == wire_type and 0 < number <= len(names):
+            values[names[number - 1]], = struct.unpack_from(fmt, raw, value_start)
+    return values
+
+
+def _pose(raw, start, end):
+    pose = {}
+    for number, _, _, value_start, value_end in iter_fields(raw, start, end):
+        if number == POSE_TRANSLATION:
+            pose["translation"] = _fixed_fields(raw, value_start, value_end, TRANSLATION_FIELDS, FIXED64, "<d")
+        elif number == POSE_ROTATION:
+            pose["rotation"] = _fixed_fields(raw, value_start, value_end, ROTATION_FIELDS, FIXED64, "<d")
+    return pose
+
+
+def _image(raw, start, end):
+    """:return: {"width", "height"} of an image message, the data field is skipped"""
+    image = {"width": 0, "height": 0}
+    for number, wire_type, _, value_start, _ in iter_fields(raw, start, end):
+        if wire_type == VARINT and number == IMAGE_WIDTH:
+            image["width"] = decode_scalar(raw, wire_type, value_start)
+        elif wire_type == VARINT and number == IMAGE_HEIGHT:
+            image["height"] = decode_scalar(raw, wire_type, value_start)
+    return image
+
+
+def _color_image(raw, start, end):
+    """:return: {"width", "height", "encoding"} of a color image message (see cortex.imaging)"""
+    image = _image(raw, start, end)
+    data = b""
+    for number, _, _, value_start, value_end in iter_fields(raw, start, end):
+        if number == IMAGE_DATA:  # only the head of the data is looked at
+            data = memoryview(raw)[value_start:value_end]
+            break
+    image["encoding"] = detect_encoding(data, image["width"], image["height"])
+    return image
+
+
+def _feelings(raw, start, end):
+    feelings = _fixed_fields(raw, start, end, FEELINGS_FIELDS, FIXED32, "<f")
+    return {name: _shortest_float(value) for name, value in feelings.items()}
+
+
+# snapshot field number: (name, decoder of the submessage raw[start:end])
+_SNAPSHOT_MESSAGES = {
+    SNAPSHOT_POSE: ("pose", _pose),
+    SNAPSHOT_COLOR_IMAGE: ("color_image", _color_image),
+    SNAPSHOT_DEPTH_IMAGE: ("depth_image", _image),
+    SNAPSHOT_FEELINGS: ("feelings", _feelings),
+}
+
+
+def snapshot_message(raw, snapshot_path="", data_paths=None, spans=None):
+    """
+    :param raw: serialized snapshot (bytes-like)
+    :param snapshot_path: path relating the snapshot to its user (users/user_id/snapshots/snapshot_id)
+    :param data_paths: {field name: path of its saved data} - e.g. {"color_image": "..."}
+    :param spans: result of scan_fields(raw), if it was already computed
+    :return: message dict, the images hold width, height and data_path instead of their data
+             (and the color image its encoding)
+    :raise MessageError: malformed snapshot
+    """
+    data_paths = data_paths or {}
+    try:
+        spans = scan_fields(raw) if spans is None else spans
+        message = {"datetime": "0"}
+        for number, occurrences in sorted(spans.items()):
+            wire_type, _, start, end = occurrences[-1]
+            if number == SNAPSHOT_DATETIME and wire_type == VARINT:
+                message["datetime"] = str(decode_scalar(raw, wire_type, start))
+            elif number in _SNAPSHOT_MESSAGES:
+                name, decode = _SNAPSHOT_MESSAGES[number]
+                message[name] = decode(raw, start, end)
+                if name in data_paths:
+                    message[name]["data_path"] = str(data_paths[name])
+    except (WireError, struct.error) as e:
+        raise MessageError("malformed snapshot: {}".format(e)) from None
+    message["snapshot_path"] = snapshot_path if snapshot_path else ""
+    return message
+
+
+def _msgpack_dumps(message):
+    if msgpack is None:
+        raise MessageError("msgpack messages require the msgpack package")
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def _msgpack_loads(body):
+    if msgpack is None:
+        raise MessageError("msgpack messages require the msgpack package")
+    return msgpack.unpackb(body, raw=False)
+
+
+# format: (content type, encode, decode)
+formats = {
+    "json": (JSON_CONTENT_TYPE, lambda message: json.dumps(message).encode(), json.loads),
+    "msgpack": (MSGPACK_CONTENT_TYPE, _msgpack_dumps, _msgpack_loads),
+}
+
+
+def available_formats():
+    """:return: names of the message formats that can be encoded here"""
+    return [name for name in formats if name != "msgpack" or msgpack is not None]
+
+
+def encode_message(message, format=DEFAULT_FORMAT):
+    """
+    :param message: dict
+    :param format: "json" or "msgpack"
+    :return: (body bytes, content type)
+    """
+    if format not in formats:
+        raise MessageError("unknown message format: {}".format(format))
+    content_type, encode, _ = formats[format]
+    return encode(message), content_type
+
+
+def decode_message(body, content_type=None):
+    """
+    :param body: message body as published (bytes or str)
+    :param content_type: content type of the message, None - JSON (messages published before it was set)
+    :return: message dict
+    """
+    for format_content_type, _, decode in formats.values():
+        if content_type in (None, "", format_content_type):
+            return decode(body)
+    raise MessageError("unsupported message content type: {}".format(content_type))
@@ -1,9 +1,11 @@
-from .rabbitmq import RabbitMQ
+from .rabbitmq import PublishError, RabbitMQ, RabbitMQPublisher
 
 # it was preferable to create a local dict of msgqueue classes as there is only one
 # but it can be updated easily
 # on some point we may want to create a config yaml file containing all the msgqueue
 msg_brokers = {"rabbitmq": RabbitMQ}
+# long-lived publishers (see RabbitMQPublisher), one per server process
+msg_publishers = {"rabbitmq": RabbitMQPublisher}
 
 
 def find_msg_broker(url):
@@ -14,3 +16,13 @@ def find_msg_broker(url):
             return cls(url)
 
     raise ValueError(f'invalid url: {url}')
+
+
+def find_msg_publisher(url, **kwargs):
+    for scheme, cls in msg_publishers.items():
+        if url.startswith(scheme):
+            if "//" in url:
+                _, url = url.split("//")
+            return cls(url, **kwargs)
+
+    raise ValueError(f'invalid url: {url}')
@@ -1,17 +1,25 @@
+import collections
 import pika
+import threading
+from concurrent.futures import Future
 
 
 def callback(ch, method, properties, body):
     print(" [x] %r _ %r" % (body, properties))
 
 
+def connection_parameters(url):
+    """:param url: host or host:port"""
+    if ":" in url:
+        host, port = url.strip("/").split(":")
+        return pika.ConnectionParameters(host, port)
+    return pika.ConnectionParameters(url.strip("/"))
+
+
 class RabbitMQ:
     def __init__(self, url):
-        if ":" in url:
-            self.host, self.port = url.strip("/").split(":")
-            params = pika.ConnectionParameters(self.host, self.port)
-        else:
-            params = pika.ConnectionParameters(url)
+        params = connection_parameters(url)
+        self.host, self.port = params.host, params.port
         self.connection = pika.BlockingConnection(params)
         self.channel = self.connection.channel()
         self.exchange = 'snapshot'
@@ -43,3 +51,171 @@ class RabbitMQ:
             on_message_callback=callback,
             auto_ack=True)
         self.channel.start_consuming()
+
+
+class PublishError(RuntimeError):
+    pass
+
+
+class RabbitMQPublisher:
+    def __init__(self, url, exchange='snapshot', batch_size=256, reconnect_delay=1.0):
+        """
+        Long-lived publisher: a single connection and channel, owned by a background I/O thread
+        (pika connections aren't thread safe), shared by all the threads of the process.
+        The exchange is declared once per connection, messages are published in batches
+        with publisher confirms, and the connection is reopened (after reconnect_delay) when it fails.
+
+        Create it in the process that uses it (after forking workers), not before.
+
+        :param url: host or host:port of the broker
+        :param batch_size: max number of messages published per turn of the I/O loop
+        :param reconnect_delay: seconds between connection attempts
+        """
+        self.parameters = connection_parameters(url)
+        self.exchange = exchange
+        self.batch_size = max(batch_size, 1)
+        self.reconnect_delay = reconnect_delay
+        self._queue = collections.deque()  # (msg, props, future) waiting for the channel
+        self._unconfirmed = collections.OrderedDict()  # delivery tag: future, touched by the I/O thread only
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None  # set once the exchange is declared and confirms are enabled
+        self._delivery_tag = 0
+        self._closing = False
+        self._closed = threading.Event()  # interrupts the wait between connection attempts
+        self._thread = threading.Thread(target=self._run, name="rabbitmq-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self, msg, props=None):
+        """
+        queue msg to the exchange (thread safe)
+
+        :return: concurrent.futures.Future resolved once the broker confirms the message,
+                 failing with PublishError if it is rejected or the connection is lost first.
+                 Cancelling it (e.g. once the caller gave up waiting) withdraws the message if it wasn't sent yet
+        """
+        future = Future()
+        with self._lock:
+            if self._closing:
+                raise PublishError("publisher is closed")
+            self._queue.append((msg, props, future))
+            connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._flush)
+            except Exception:  # the connection is going down, the message is sent by the next one
+                pass
+        return future
+
+    def close(self, timeout=10):
+        """wait (up to timeout seconds) for the queued messages to be confirmed and close the connection"""
+        with self._lock:
+            self._closing = True
+            connection = self._connection
+        self._closed.set()
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close_if_done)
+            except Exception:
+                pass
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            connection = pika.SelectConnection(self.parameters,
+                                               on_open_callback=self._on_connection_open,
+                                               on_open_error_callback=self._on_connection_error,
+                                               on_close_callback=self._on_connection_error)
+            with self._lock:
+                self._connection = connection
+            connection.ioloop.start()  # until the connection is closed
+            with self._lock:
+                self._connection = None
+                self._channel = None
+                closing = self._closing
+            self._fail_pending("no connection to the broker")
+            if closing or self._closed.wait(self.reconnect_delay):
+                return
+
+    def _fail_pending(self, reason):
+        """
+        fail the futures of the unconfirmed and queued messages. The unconfirmed ones may or may not have been
+        routed, a caller retrying one of them may deliver it twice
+        """
+        with self._lock:
+            futures = [future for _, _, future in self._queue if not future.cancelled()]
+            self._queue.clear()
+        futures = list(self._unconfirmed.values()) + futures
+        self._unconfirmed.clear()
+        for future in futures:
+            future.set_exception(PublishError(reason))
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(exchange=self.exchange, exchange_type='fanout',
+                                 callback=lambda _: channel.confirm_delivery(
+                                     self._on_delivery_confirmation, callback=lambda _: self._on_ready(channel)))
+
+    def _on_ready(self, channel):
+        self._delivery_tag = 0
+        self._channel = channel
+        self._flush()
+
+    def _on_channel_closed(self, channel, reason):
+        self._channel = None
+        connection = channel.connection
+        if connection.is_open:  # reopen both
+            connection.close()
+
+    def _flush(self):
+        channel = self._channel
+        if channel is None:
+            return
+        with self._lock:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            more = len(self._queue) > 0
+        for msg, props, future in batch:
+            if not future.set_running_or_notify_cancel():  # withdrawn by the caller
+                continue
+            channel.basic_publish(exchange=self.exchange, routing_key='', body=msg, properties=props)
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = future
+        if more:  # let the loop handle the confirms before the next batch
+            channel.connection.ioloop.call_later(0, self._flush)
+        self._close_if_done()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future = self._unconfirmed.pop(tag, None)
+            if future is None:
+                continue
+            if acked:
+                future.set_result(None)
+            else:
+                future.set_exception(PublishError("message was rejected by the broker"))
+        self._close_if_done()
+
+    def _close_if_done(self):
+        with self._lock:
+            done = self._closing and not self._queue and not self._unconfirmed
+            connection = self._connection
+        if done and connection is not None and connection.is_open:
+            connection.close()
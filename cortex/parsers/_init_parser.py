@@ -3,7 +3,9 @@ import json
 import os
 import sys
 from cortex.loader import load_modules
+from cortex.messages import decode_message
 from cortex.msgbrokers import find_msg_broker
+from cortex.msgbrokers.rabbitmq import callback as print_message
 from pathlib import Path
 
 WARNING_PREFIX = "Warning:"
@@ -96,7 +98,7 @@ def run_parser(parser_name, data):
 
 class Context:
     def __init__(self, snapshot_path="/tmp"):
-        self.snapshot_path = snapshot_path
+        self.snapshot_path = Path(snapshot_path)
         self.msg_broker = None
 
     def path(self, file_name, snapshot_path=""):
@@ -132,10 +134,17 @@ def setup_publisher(url, data, props=None):
 
 
 def setup_consumer(url, callback=None):
+    """
+    :param callback: function(channel, method, properties, message) - as a pika callback, but the message
+                     is already decoded (a dict) according to its content type (JSON or msgpack, see cortex.messages)
+    """
+    if callback is None:  # message broker has a default callback function
+        callback = print_message
+
+    def on_message(ch, method, properties, body):
+        callback(ch, method, properties, decode_message(body, properties.content_type))
+
     with find_msg_broker(url) as msq:
         msq.declare_exchange()
         queue_name = msq.queue_declare()
-        if callback is None:  # message broker has a default callback function
-            msq.consume(queue_name)
-        else:
-            msq.consume(queue_name, callback=callback)
+        msq.consume(queue_name, callback=on_message)
@@ -1,15 +1,55 @@
+import io
+import json
+import numpy as np
 from PIL import Image
+from cortex.segments import read_data
+
+
+ERROR_PREFIX = "Error:"
+
 
-###################
-# NOT IMPLEMENTED
-###################
 def parse_color_image(context, snapshot):
-    pass
-    path = context.path('color_image.jpg')
-    size = snapshot.color_image.width, snapshot.color_image.height
-    image = Image.new('RGB', size)
-    image.putdata(snapshot.color_image.data)
-    image.save(path)
+    """
+    convert the color image saved by the server (see data_path, a segment reference or a file)
+    to a jpg image, the data is raw RGB bytes or an encoded image (see the encoding field)
+
+    :param context: context object that includes common functions such as path
+    :param snapshot: serialized json data or a dictionary
+    :return: parsed data as dict
+    """
+    if not isinstance(snapshot, dict):
+        snapshot = json.loads(snapshot)
+
+    color_image = snapshot.get(parse_color_image.tag, {})
+    if "data_path" not in color_image:
+        print(f'{ERROR_PREFIX} couldn\'t find {parse_color_image.tag} data in supplied data.')
+        # no data to parse
+        return {}
+
+    width, height = int(color_image.get("width", 0)), int(color_image.get("height", 0))
+    path = context.path('color_image.jpg', snapshot.get("snapshot_path", ""))
+    encoding = color_image.get("encoding", "raw")
+    data = read_data(color_image["data_path"])
+    if encoding == "jpeg":  # re-encoded by the client, already a jpg
+        with open(path, "wb") as f:
+            f.write(data)
+    elif encoding != "raw":  # e.g. webp
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            image.convert('RGB').save(path)
+    else:
+        # a (height, width, 3) view over the mapped data, no per-pixel work
+        pixels = np.frombuffer(data, dtype=np.uint8)
+        if pixels.size != width * height * 3:
+            print(f'{ERROR_PREFIX} {parse_color_image.tag} size doesn\'t match {width}x{height}.')
+            return {}
+        Image.fromarray(pixels.reshape(height, width, 3), 'RGB').save(path)
+    return {
+        "snapshot_path": snapshot.get("snapshot_path", ""),
+        "timestamp": snapshot.get("datetime"),
+        "parser": parse_color_image.tag,
+        "result": {"path": str(path), "width": width, "height": height},
+    }
 
 
 parse_color_image.tag = 'color_image'
@@ -1,20 +1,48 @@
+import json
 import matplotlib
+from cortex.depth import load_depth
+
+matplotlib.use("Agg")  # parsers run headless
 import matplotlib.pyplot as plt
 
-###################
-# NOT IMPLEMENTED
-###################
+
+ERROR_PREFIX = "Error:"
+
+
 def parse_depth_image(context, snapshot):
-    pass
-    path = context.path('depth_image.jpg')
-    size = snapshot.color_image.width, snapshot.color_image.height
-
-    fig, ax = plt.subplots()
-    im = ax.imshow(snapshot.data)
-    plt.savefig(path, pil_kwargsdict={"size": size})
-    # ax.set_title("Depth Image")
-    fig.tight_layout()
-    plt.show()
+    """
+    render the depth array saved by the server (see data_path) as a heat map jpg image.
+    data_path is a segment reference of the depth stored with a codec (see cortex.depth),
+    or a .npy file (saved before segments)
+
+    :param context: context object that includes common functions such as path
+    :param snapshot: serialized json data or a dictionary
+    :return: parsed data as dict
+    """
+    if not isinstance(snapshot, dict):
+        snapshot = json.loads(snapshot)
+
+    depth_image = snapshot.get(parse_depth_image.tag, {})
+    if "data_path" not in depth_image:
+        print(f'{ERROR_PREFIX} couldn\'t find {parse_depth_image.tag} data in supplied data.')
+        # no data to parse
+        return {}
+
+    width, height = int(depth_image.get("width", 0)), int(depth_image.get("height", 0))
+    # float32 whatever its codec - memory mapped, not copied, if it was stored as float32
+    depth = load_depth(depth_image)
+    if depth.ndim == 1:  # flat - the size doesn't match
+        print(f'{ERROR_PREFIX} {parse_depth_image.tag} size doesn\'t match {width}x{height}.')
+        return {}
+
+    path = context.path('depth_image.jpg', snapshot.get("snapshot_path", ""))
+    plt.imsave(path, depth, cmap="hot")
+    return {
+        "snapshot_path": snapshot.get("snapshot_path", ""),
+        "timestamp": snapshot.get("datetime"),
+        "parser": parse_depth_image.tag,
+        "result": {"path": str(path), "width": width, "height": height},
+    }
 
 
 parse_depth_image.tag = 'depth_image'
@@ -0,0 +1,159 @@
+"""
+Prefetching pipeline for Reader.
+
+A framing thread inflates the sample (through its own cursor, the reader's file isn't touched)
+and cuts it into raw records, a pool of workers parses them and a bounded queue of futures
+hands the snapshots to the caller in order, so decompression and parsing run ahead of
+the consumer (e.g. the uploader).
+When the sample index holds restore points that cover the file, inflate itself can be
+split between several threads (zlib releases the GIL while inflating).
+"""
+
+import queue
+import struct
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from cortex.formats import read_record, DECODE_ERRORS
+from cortex.index import HEADER_SIZE
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def read_raw_records(index, start, stop):
+    """
+    :param index: SampleIndex
+    :param start: first snapshot index
+    :param stop: end snapshot index (exclusive)
+    :return: list of serialized snapshots
+    """
+    records = []
+    offset, _ = index.record(start)
+    with index.open_at(offset) as cursor:
+        for _ in range(start, stop):
+            length, = struct.unpack("I", cursor.read(HEADER_SIZE))
+            records.append(cursor.read(length))
+    return records
+
+
+class Prefetcher:
+    def __init__(self, cursor, offset, position, depth, parse, parse_workers=2, inflate_workers=1, index=None):
+        """
+        :param cursor: file object of the sample positioned at offset, read (and closed) by the prefetcher
+        :param offset: uncompressed offset of the first snapshot to prefetch
+        :param position: index of the first snapshot to prefetch
+        :param depth: max number of snapshots waiting for the consumer
+        :param parse: function: serialized snapshot -> snapshot object
+        :param parse_workers: number of parsing threads
+        :param inflate_workers: number of inflating threads, used only if the sample index
+                                has restore points covering the remaining records
+        :param index: SampleIndex of the sample, if it is loaded
+        """
+        self.offset = offset  # uncompressed offset of the first snapshot not returned yet
+        self.error = None  # decompression error that ended the records (a damaged tail), set before the end
+        self.parse = parse
+        self._cursor = cursor
+        self._position = position
+        self._index = index
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._parse_pool = ThreadPoolExecutor(max_workers=max(parse_workers, 1))
+        self._inflate_workers = inflate_workers
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is _END:
+            self._queue.put(_END)  # keep raising StopIteration on further calls
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self._queue.put(_END)
+            raise item.error
+        future, self.offset = item
+        return future.result()
+
+    def close(self):
+        self._stop.set()
+        try:  # unblock the framing thread
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join()
+        self._parse_pool.shutdown(wait=True)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for record, end in self._records():
+                if not self._put((self._parse_pool.submit(self.parse, record), end)):
+                    return
+        except Exception as e:
+            self._put(_Failure(e))
+            return
+        finally:
+            self._cursor.close()
+        self._put(_END)
+
+    def _records(self):
+        """:return: yields (record, uncompressed offset of the next record)"""
+        if self._inflate_workers > 1 and self._index_covers_remaining():
+            yield from self._parallel_records()
+        else:
+            offset = self.offset
+            while True:
+                try:
+                    record = read_record(self._cursor)
+                except DECODE_ERRORS as e:  # the records before it are intact
+                    self.error = e
+                    return
+                if record is None:
+                    return
+                offset += HEADER_SIZE + len(record)
+                yield record, offset
+
+    def _index_covers_remaining(self):
+        index = self._index
+        return index is not None and self._position < len(index) and index.covers(index.record(len(index) - 1)[0])
+
+    def _parallel_records(self):
+        """inflate ranges of about index.spacing bytes in parallel and yield their records in order"""
+        index = self._index
+        ranges = []
+        start = self._position
+        while start < len(index):
+            stop = max(bisect_left(index.offsets, index.offsets[start] + index.spacing), start + 1)
+            ranges.append((start, stop))
+            start = stop
+        with ThreadPoolExecutor(max_workers=self._inflate_workers) as pool:
+            pending = []
+            for start, stop in ranges:
+                pending.append((start, pool.submit(read_raw_records, index, start, stop)))
+                if len(pending) > self._inflate_workers:
+                    yield from self._with_offsets(index, *pending.pop(0))
+                if self._stop.is_set():
+                    return
+            for start, future in pending:
+                yield from self._with_offsets(index, start, future)
+
+    @staticmethod
+    def _with_offsets(index, start, future):
+        for i, record in enumerate(future.result(), start):
+            yield record, index.offsets[i] + index.lengths[i]
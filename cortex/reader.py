@@ -1,7 +1,13 @@
 import cortex.cortex_pb2 as cortex_pb2
-import gzip
+import functools
 import os
 import struct
+import warnings
+from cortex.arrays import snapshot_columns
+from cortex.formats import detect_format, SampleWriter, DECODE_ERRORS
+from cortex.index import get_index, DEFAULT_SPACING, HEADER_SIZE
+from cortex.lazy import LazySnapshot, ALWAYS_SELECTED
+from cortex.prefetch import Prefetcher
 from datetime import datetime
 # from google.protobuf.json_format import MessageToDict, MessageToJson
 
@@ -11,6 +17,29 @@ def serialize(snapshot_ob):
     return new_snap
 
 
+def serialize_fields(snapshot_ob, fields):
+    """
+    serialize only the supplied fields of a snapshot (and datetime), without copying the others
+
+    :param snapshot_ob: cortex_pb2.Snapshot or LazySnapshot
+    :param fields: names of snapshot fields
+    :return: serialized pruned snapshot
+    """
+    fields = set(fields) | set(ALWAYS_SELECTED)
+    if isinstance(snapshot_ob, LazySnapshot):
+        if set(snapshot_ob.fields) <= fields:
+            return snapshot_ob.SerializeToString()
+        return LazySnapshot(snapshot_ob.raw, fields & set(snapshot_ob.fields)).SerializeToString()
+    pruned = create_empty_snapshot()
+    for desc, val in snapshot_ob.ListFields():
+        if desc.name in fields:
+            if desc.message_type is not None:
+                getattr(pruned, desc.name).CopyFrom(val)
+            else:
+                setattr(pruned, desc.name, val)
+    return pruned.SerializeToString()
+
+
 def create_empty_snapshot():
     snap = cortex_pb2.Snapshot()
     return snap
@@ -23,19 +52,76 @@ def parse_from(serialized_snapshot):
     return snap
 
 
+def parse_record(snapshot_msg, fields=None):
+    """:return: a new snapshot object (or LazySnapshot view of the fields, if they are supplied)"""
+    if fields is not None:
+        return LazySnapshot(snapshot_msg, fields)
+    return parse_from(snapshot_msg)
+
+
+def convert_sample(src, dst, format=None, level=None):
+    """
+    copy the records of a sample to a new sample in another container format (no protobuf is parsed)
+
+    :param src: path to an existing sample
+    :param dst: path to the new sample
+    :param format: "gzip", "zstd" or "raw", by default chosen by the extension of dst
+    :param level: compression level
+    :return: number of snapshots copied
+    """
+    count = 0
+    with Reader(src) as reader, SampleWriter(dst, format, level) as writer:
+        writer.write_user(reader.user)
+        while True:
+            snapshot_msg = reader.read_msg()
+            if snapshot_msg is None:
+                return count
+            writer.write_snapshot(snapshot_msg)
+            count += 1
+
+
 class Reader:
-    def __init__(self, filename):
-        if not filename.endswith('.gz'):
-            raise NameError("Expected gz file")
+    def __init__(self, filename, index_spacing=DEFAULT_SPACING, prefetch=0, parse_workers=2, inflate_workers=1,
+                 fields=None, index=None):
+        """
+        :param filename: path to a sample - gzip, zstd or raw (see cortex.formats)
+        :param fields: if supplied (e.g. ("pose", "feelings")), snapshots are returned as LazySnapshot
+                       views exposing these fields only (and datetime). Fields are decoded on access,
+                       images that were not selected are never parsed
+        :param index: SampleIndex of the sample that was already loaded (e.g. shared with another reader)
+        :param index_spacing: distance (in uncompressed bytes) between the restore points
+                              of the sample index (see cortex.index), used by seek, len and []
+        :param prefetch: if > 0, iterate with a background pipeline (see cortex.prefetch)
+                         keeping up to prefetch parsed snapshots ahead of the caller
+        :param parse_workers: number of parsing threads in prefetch mode
+        :param inflate_workers: number of inflating threads in prefetch mode. Used only when
+                                the sample index already holds restore points for the file
+                                (e.g. after len(reader) built the index in this process)
+
+        A sample whose tail is truncated or corrupt is read up to its last intact snapshot,
+        the damage is then described by reader.error (and a warning)
+        """
         if not os.path.exists(filename):
             raise IOError("No such file or directory: '{}'".format(filename))
+        self.__file_object = None  # closed by __del__ even if the format isn't supported
+        self.__prefetcher = None
         self.filename = filename
-        self.__file_object = gzip.open(self.filename, "r")
+        self.format = detect_format(filename)
+        self.index_spacing = index_spacing
+        self.prefetch = prefetch
+        self.parse_workers = parse_workers
+        self.inflate_workers = inflate_workers
+        self.fields = fields
+        self.__index = index
+        self.__file_object = self.format.open(self.filename)
         self.user = cortex_pb2.User()
         self.read_user()
         self.snapshot = cortex_pb2.Snapshot()
+        self.position = 0  # index of the next snapshot to be read
+        self.error = ""  # description of a damaged tail met while reading, empty if none was
 
     def __del__(self):
+        self._stop_prefetch(reposition=False)
         if self.__file_object:
             self.__file_object.close()
 
@@ -43,6 +129,7 @@ class Reader:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_prefetch(reposition=False)
         if self.__file_object:
             self.__file_object.close()
 
@@ -50,12 +137,125 @@ class Reader:
         return self
 
     def __next__(self):
-        self.read_snapshot()
-        if self.snapshot:
+        if self.prefetch > 0:
+            if self.__prefetcher is None:
+                # the prefetcher reads from its own cursor and doesn't reference the reader,
+                # so that __del__ stops it
+                offset = self.__file_object.tell()
+                self.__prefetcher = Prefetcher(self._open_at(offset), offset, self.position, self.prefetch,
+                                               functools.partial(parse_record, fields=self.fields),
+                                               self.parse_workers, self.inflate_workers, self.__index)
+            try:
+                self.snapshot = next(self.__prefetcher)
+            except StopIteration:
+                if self.__prefetcher.error is not None:
+                    self._damaged(self.__prefetcher.error)
+                raise
+            self.position += 1
+            return self.snapshot
+        if self.read_snapshot():
             return self.snapshot
         else:
             raise StopIteration
 
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        """
+        random access to snapshots by index (or slice) without changing the iteration position
+
+        :param key: int or slice
+        :return: a new snapshot object or a list of snapshots
+        """
+        if isinstance(key, slice):
+            indices = range(len(self))[key]
+            if indices.step != 1:
+                return [self[i] for i in indices]
+            return list(self._read_range(indices.start, indices.stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("snapshot index out of range")
+        return next(self._read_range(key, key + 1))
+
+    @property
+    def index(self):
+        """sample index (see cortex.index), loaded from its sidecar file or built on first use"""
+        if self.__index is None:
+            self.__index = get_index(self.filename, self.index_spacing)
+        return self.__index
+
+    def _open_at(self, offset):
+        """:return: file object of the sample positioned at the uncompressed offset"""
+        if self.__index is not None:
+            return self.__index.open_at(offset)
+        return self.format.open(self.filename, offset)
+
+    def _read_range(self, start, stop):
+        if start >= stop:
+            return
+        offset, _ = self.index.record(start)
+        with self.index.open_at(offset) as cursor:
+            for i in range(start, stop):
+                length, = struct.unpack("I", cursor.read(HEADER_SIZE))
+                yield self._parse(cursor.read(length))
+
+    def seek(self, i):
+        """
+        move the iteration position so that the next snapshot read is snapshot i
+
+        :param i: snapshot index (0 based), len(reader) positions the reader at its end
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i <= len(self):
+            raise IndexError("snapshot index out of range")
+        offset = self.index.record(i)[0] if i < len(self) else self.index.size
+        self._stop_prefetch(reposition=False)
+        self.__file_object.close()
+        self.__file_object = self.index.open_at(offset)
+        self.position = i
+
+    def iter_batches(self, size=1024):
+        """
+        Read the remaining snapshots as column batches (see cortex.arrays.SnapshotBatch):
+        numpy arrays of datetime, pose translation/rotation and feelings, instead of a
+        snapshot object per step. Images are skipped.
+
+        :param size: max number of snapshots per batch
+        :return: yields SnapshotBatch
+        """
+        self._stop_prefetch()
+        while True:
+            records = []
+            while len(records) < size:
+                snapshot_msg = self.read_msg()
+                if snapshot_msg is None:
+                    break
+                records.append(snapshot_msg)
+            if not records:
+                return
+            self.position += len(records)
+            yield snapshot_columns(records)
+
+    def _parse(self, snapshot_msg):
+        """:return: a new snapshot object (or LazySnapshot view if fields were selected)"""
+        return parse_record(snapshot_msg, self.fields)
+
+    def _stop_prefetch(self, reposition=True):
+        """
+        :param reposition: move the file to the first snapshot the prefetcher didn't return,
+                           so that read_msg goes on from self.position
+        """
+        if self.__prefetcher is None:
+            return
+        prefetcher, self.__prefetcher = self.__prefetcher, None
+        prefetcher.close()
+        if reposition:
+            self.__file_object.close()
+            self.__file_object = self._open_at(prefetcher.offset)
+
     def read_in_chunks(self, chunk_size=1024):
         """Lazy function (or generator) to read a file piece by piece.
         Default chunk size: 1k."""
@@ -67,14 +267,41 @@ class Reader:
             return data
 
     def read_msg(self):
-        msg_len, = struct.unpack("I", self.read_in_chunks(4))
-        msg = self.read_in_chunks(msg_len)
-        return msg
+        """
+        :return: next message, or None at the end of file (or if the last message is truncated or corrupt,
+                 see error)
+        """
+        try:
+            header = self.read_in_chunks(HEADER_SIZE)
+            if header is None or len(header) < HEADER_SIZE:
+                return None
+            msg_len, = struct.unpack("I", header)
+            msg = self.read_in_chunks(msg_len)
+        except DECODE_ERRORS as e:
+            self._damaged(e)
+            return None
+        if msg_len and (msg is None or len(msg) < msg_len):
+            return None
+        return msg or b""
+
+    def _damaged(self, error):
+        """the rest of the sample can't be decompressed, reading stops at the last intact snapshot"""
+        if not self.error:
+            self.error = "truncated or corrupt sample tail: {}".format(error)
+            warnings.warn("{}: {}".format(self.filename, self.error))
 
     def read_snapshot(self):
+        """:return: True if a snapshot was read into self.snapshot, False at the end of file"""
         snapshot_msg = self.read_msg()
+        if snapshot_msg is None:
+            return False
         # retrieve snapshot
-        self.snapshot.ParseFromString(snapshot_msg)
+        if self.fields is not None:
+            self.snapshot = LazySnapshot(snapshot_msg, self.fields)
+        else:
+            self.snapshot.ParseFromString(snapshot_msg)
+        self.position += 1
+        return True
 
     def read_user(self):
         user_msg = self.read_msg()
@@ -0,0 +1,253 @@
+"""
+Append-only segment storage of the snapshot data.
+
+The data of a kind (e.g. the color images) is kept under a root directory, in a directory per user:
+    <root>/<user_id>/<segment number>.seg   blobs appended one after the other, a segment is
+                                             closed once it is over max_segment_size
+    <root>/<user_id>/index                  a fixed size record per blob (see _RECORD)
+instead of a file (and an inode) per snapshot.
+Appends are serialized with an exclusive lock (flock) on the index, so several processes
+may write to the same store. A blob is referenced by its location:
+    segment:<segment path>@<offset>+<length>
+which is what data_path holds - readers map the segment, no index lookup is needed.
+Blobs can also be fetched by (user_id, snapshot_id), the last blob appended for a snapshot wins.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+REFERENCE_PREFIX = "segment:"
+SEGMENT_SUFFIX = ".seg"
+INDEX_NAME = "index"
+DEFAULT_SEGMENT_SIZE = 256 << 20
+# snapshot id, segment number, offset, length
+_RECORD = struct.Struct("<QIQI")
+
+
+class SegmentError(Exception):
+    pass
+
+
+def is_reference(data_path):
+    return str(data_path).startswith(REFERENCE_PREFIX)
+
+
+def make_reference(segment_path, offset, length):
+    return "{}{}@{}+{}".format(REFERENCE_PREFIX, segment_path, offset, length)
+
+
+def parse_reference(reference):
+    """:return: (segment path, offset, length)"""
+    try:
+        path, location = reference[len(REFERENCE_PREFIX):].rsplit("@", 1)
+        offset, length = location.split("+")
+        return path, int(offset), int(length)
+    except ValueError:
+        raise SegmentError("invalid segment reference: {}".format(reference)) from None
+
+
+def _view(map, offset, length):
+    if offset + length > len(map):
+        raise SegmentError("blob at {}+{} is past the end of the segment".format(offset, length))
+    return memoryview(map)[offset:offset + length]
+
+
+def read_reference(reference):
+    """
+    :param reference: segment reference (a data_path, see make_reference)
+    :return: read-only memoryview of the blob over a map of its segment (valid as long as it is referenced)
+    """
+    path, offset, length = parse_reference(reference)
+    if length == 0:
+        return memoryview(b"")
+    with open(path, "rb") as f:
+        return _view(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), offset, length)
+
+
+def read_data(data_path):
+    """
+    :param data_path: segment reference or path of a file (as saved before segments)
+    :return: read-only bytes-like data, mapped - not read into memory
+    """
+    if is_reference(data_path):
+        return read_reference(data_path)
+    with open(data_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _segment_name(number):
+    return "{:08d}{}".format(number, SEGMENT_SUFFIX)
+
+
+class SegmentStore:
+    def __init__(self, root, max_segment_size=DEFAULT_SEGMENT_SIZE, max_open=64):
+        """
+        :param root: directory of the store
+        :param max_segment_size: a new segment is started once the current one is over this size (bytes)
+        :param max_open: max number of users whose files are kept open
+        """
+        self.root = Path(root)
+        self.max_segment_size = max_segment_size
+        self.max_open = max_open
+        self._users = OrderedDict()  # user_id: _UserSegments, least recently used first
+        self._lock = threading.Lock()
+
+    def _acquire(self, user_id):
+        """:return: the _UserSegments of the user, in use until it is released (see _release)"""
+        with self._lock:
+            user = self._users.pop(user_id, None)
+            if user is None:
+                user = _UserSegments(self.root / str(user_id))
+            self._users[user_id] = user
+            user.in_use += 1
+            evicted = []
+            while len(self._users) > self.max_open:
+                _, least_recent = self._users.popitem(last=False)
+                least_recent.evicted = True
+                if least_recent.in_use == 0:  # otherwise closed by the last thread releasing it
+                    evicted.append(least_recent)
+        for least_recent in evicted:
+            least_recent.close()
+        return user
+
+    def _release(self, user):
+        with self._lock:
+            user.in_use -= 1
+            close = user.evicted and user.in_use == 0
+        if close:
+            user.close()
+
+    def append(self, user_id, snapshot_id, data, fsync=False):
+        """
+        :param data: blob (bytes-like)
+        :param fsync: flush the segment and the index to the disk before returning
+        :return: reference of the blob
+        """
+        user = self._acquire(user_id)
+        try:
+            return user.append(snapshot_id, data, self.max_segment_size, fsync)
+        finally:
+            self._release(user)
+
+    def fetch(self, user_id, snapshot_id):
+        """
+        :return: read-only memoryview of the last blob appended for the snapshot
+        :raise KeyError: no blob of the snapshot
+        """
+        user = self._acquire(user_id)
+        try:
+            return user.fetch(snapshot_id)
+        finally:
+            self._release(user)
+
+    def close(self):
+        with self._lock:
+            idle = []
+            for user in self._users.values():
+                user.evicted = True
+                if user.in_use == 0:  # otherwise closed by the last thread releasing it
+                    idle.append(user)
+            self._users.clear()
+        for user in idle:
+            user.close()
+
+
+class _UserSegments:
+    def __init__(self, directory):
+        self.directory = directory
+        self.in_use = 0  # number of threads using it, guarded by the lock of the store
+        self.evicted = False  # no longer in the store, closed once it isn't in use
+        self._index = None  # opened on use
+        self._segment = None  # (number, file object) of the segment being appended to
+        self._offsets = {}  # snapshot id: (segment number, offset, length), as read from the index
+        self._indexed = 0  # size of the index read into _offsets
+        self._maps = {}  # segment number: mmap
+        self._lock = threading.Lock()
+
+    def append(self, snapshot_id, data, max_segment_size, fsync):
+        data = memoryview(data).cast("B")
+        with self._lock:
+            self._open()
+            fcntl.flock(self._index, fcntl.LOCK_EX)  # other processes append to the same files
+            try:
+                number = self._last_segment()
+                path = self.directory / _segment_name(number)
+                offset = path.stat().st_size if path.exists() else 0
+                if offset > 0 and offset + len(data) > max_segment_size:
+                    number, offset = number + 1, 0
+                    path = self.directory / _segment_name(number)
+                segment = self._open_segment(number, path)
+                segment.write(data)
+                segment.flush()
+                self._index.write(_RECORD.pack(snapshot_id, number, offset, len(data)))
+                self._index.flush()
+                if fsync:
+                    os.fsync(segment.fileno())
+                    os.fsync(self._index.fileno())
+            finally:
+                fcntl.flock(self._index, fcntl.LOCK_UN)
+        return make_reference(path, offset, len(data))
+
+    def _open(self):
+        if self._index is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._index = open(self.directory / INDEX_NAME, "a+b")
+
+    def _last_segment(self):
+        """:return: number of the segment of the last indexed blob, 0 if there is none"""
+        size = os.fstat(self._index.fileno()).st_size
+        if size % _RECORD.size:  # a torn record (a writer died), the next one is appended in its place
+            size -= size % _RECORD.size
+            os.ftruncate(self._index.fileno(), size)
+        if size == 0:
+            return 0
+        _, number, _, _ = _RECORD.unpack(os.pread(self._index.fileno(), _RECORD.size, size - _RECORD.size))
+        return number
+
+    def _open_segment(self, number, path):
+        if self._segment is None or self._segment[0] != number:
+            if self._segment is not None:
+                self._segment[1].close()
+            self._segment = (number, open(path, "ab"))
+        return self._segment[1]
+
+    def fetch(self, snapshot_id):
+        with self._lock:
+            self._open()
+            if snapshot_id not in self._offsets:
+                self._read_index()
+            number, offset, length = self._offsets[snapshot_id]
+            if length == 0:
+                return memoryview(b"")
+            map = self._maps.get(number)
+            if map is None or offset + length > len(map):  # the segment grew since it was mapped
+                with open(self.directory / _segment_name(number), "rb") as f:
+                    map = self._maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return _view(map, offset, length)
+
+    def _read_index(self):
+        """read the records appended to the index since it was last read"""
+        size = os.fstat(self._index.fileno()).st_size
+        size -= size % _RECORD.size
+        if size > self._indexed:
+            records = os.pread(self._index.fileno(), size - self._indexed, self._indexed)
+            for snapshot_id, number, offset, length in _RECORD.iter_unpack(records):
+                self._offsets[snapshot_id] = (number, offset, length)
+            self._indexed = size
+
+    def close(self):
+        with self._lock:
+            if self._segment is not None:
+                self._segment[1].close()
+                self._segment = None
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+            self._maps.clear()  # closed once the views over them are released
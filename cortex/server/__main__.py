@@ -10,10 +10,42 @@ def cli():
 @cli.command(name="run-server")
 @click.option('--host', '-h', default='127.0.0.1', help='Host')
 @click.option('--port', '-p', default=8000, help='Port')
+@click.option('--dedup-size', default=100000, help='Number of recent snapshot ids kept to drop re-uploads (0 - off)')
+@click.option('--max-pending', default=64, help='Max number of snapshot requests handled at once, '
+                                               'others are rejected with 429 (0 - no limit)')
+@click.option('--retry-after', default=1, help='Delay (seconds) suggested to the rejected clients')
+@click.option('--grpc-port', type=click.INT, default=None, help='Serve the gRPC upload service on this port as well')
+@click.option('--max-body', default=1 << 30, help='Max size (bytes) of a decoded request body (0 - no limit)')
+@click.option('--spool-size', default=8 << 20, help='Request bodies bigger than this (bytes) are spooled to disk')
+@click.option('--publish-batch', default=256, help='Max number of messages published to the message queue at once')
+@click.option('--confirm-timeout', default=10.0, help='Seconds to wait for the message queue to confirm a message')
+@click.option('--message-format', type=click.Choice(["json", "msgpack"]), default="json",
+              help='Encoding of the messages published to the message queue')
+@click.option('--write-workers', default=0, help='Threads writing the snapshot data behind the requests - they are '
+                                               'acknowledged before they are published, and lost if publishing '
+                                               'fails (0 - written and published by the requests)')
+@click.option('--write-queue', default=256, help='Max number of snapshots waiting to be written')
+@click.option('--fsync', type=click.Choice(["never", "always"]), default="never",
+              help='fsync the snapshot data before publishing')
+@click.option('--segment-size', default=256 << 20, help='Size (bytes) of the segment files storing the snapshot data')
+@click.option('--asgi', is_flag=True, help='Serve the async app with uvicorn instead of the Flask app')
+@click.option('--asgi-workers', default=8, help='Threads decoding and saving the snapshots of the async app')
+@click.option('--workers', '-w', default=0, help='Number of worker processes sharing the port '
+                                              '(0 - served by this process)')
+@click.option('--grace', default=30, help='Seconds a stopped worker is given to finish its requests')
 @click.argument('msg_queue_url', type=click.STRING)
-def cli_run_server(host, port, msg_queue_url):
-    """Run server by calling for run-server with host, port and URL to a message queue"""
-    run_server(host=host, port=port, msg_queue_url=msg_queue_url)
+def cli_run_server(host, port, dedup_size, max_pending, retry_after, grpc_port, max_body, spool_size, publish_batch,
+                   confirm_timeout, message_format, write_workers, write_queue, fsync, segment_size, asgi, asgi_workers,
+                   workers, grace, msg_queue_url):
+    """
+    Run server by calling for run-server with host, port and URL to a message queue.
+    With --workers, SIGHUP restarts the workers gracefully (re-reading the parsers config)
+    """
+    run_server(host=host, port=port, msg_queue_url=msg_queue_url, dedup_size=dedup_size, max_pending=max_pending,
+               retry_after=retry_after, grpc_port=grpc_port, max_body=max_body, spool_size=spool_size,
+               publish_batch=publish_batch, confirm_timeout=confirm_timeout, message_format=message_format,
+               write_workers=write_workers, write_queue=write_queue, fsync=fsync, segment_size=segment_size,
+               asgi=asgi, asgi_workers=asgi_workers, workers=workers, grace=grace)
 
 
 if __name__ == '__main__':
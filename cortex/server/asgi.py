@@ -0,0 +1,216 @@
+"""
+Async (ASGI) mode of the server - same routes and responses as the Flask app (FlaskInit.create_app),
+served by uvicorn (see run_server).
+A request holds no thread while its body arrives: the body is spooled as it is received, then it is decoded,
+scanned and saved in a thread pool, and the broker confirm is awaited without blocking a thread
+(the publisher futures are awaited through asyncio). A slow recorder costs a coroutine, not a thread.
+"""
+
+import asyncio
+import json
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from werkzeug.formparser import parse_form_data
+from cortex.compression import CompressionError
+from cortex.msgbrokers import PublishError
+from .body import BodyTooLarge, RequestBody
+from .server import SNAPSHOT_CONTENT_TYPE, MalformedSnapshot, body_error_response
+from .storage import ERROR_PREFIX, StorageBusy
+
+SNAPSHOT_ROUTE = re.compile(r"/snapshot/(\d+)/(\d+)")
+SNAPSHOTS_ROUTE = re.compile(r"/snapshots/(\d+)")
+NO_PUBLISHER = {"error": "no publisher and no message queue url were supplied."}
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsgiApp:
+    def __init__(self, flaskinit, workers=8):
+        """
+        :param flaskinit: FlaskInit of the server (storage, dedup, publisher and limits)
+        :param workers: number of threads decoding and saving the snapshots
+        """
+        self.flaskinit = flaskinit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asgi-worker")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            try:
+                response = await self._route(scope, receive)
+            except ClientDisconnected:
+                return
+            await self._send(send, response)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _route(self, scope, receive):
+        """:return: response - dict, "" or a tuple (body, status[, headers]) as the Flask views return"""
+        if scope["method"] != "POST":
+            return {"error": "method not allowed."}, 405
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        path = scope["path"]
+        try:
+            if path == "/new_user":
+                return await self._add_user(receive, headers)
+            match = SNAPSHOT_ROUTE.fullmatch(path)
+            if match:
+                user_id, snapshot_id = int(match.group(1)), int(match.group(2))
+                return await self._add_snapshots(receive, headers, self._read_snapshot, user_id, snapshot_id)
+            match = SNAPSHOTS_ROUTE.fullmatch(path)
+            if match:
+                query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+                try:
+                    start = int(query.get("start", ["1"])[0])
+                except ValueError:
+                    start = 1
+                return await self._add_snapshots(receive, headers, self._read_snapshots, int(match.group(1)), start)
+        except (BodyTooLarge, CompressionError, MalformedSnapshot) as e:
+            return body_error_response(e, headers.get("content-encoding", "identity").strip().lower())
+        except StorageBusy as e:
+            return {"error": str(e)}, 503, {"Retry-After": str(self.flaskinit.retry_after)}
+        except (ClientDisconnected, asyncio.CancelledError):
+            raise
+        except Exception as e:  # saving or publishing failed - as an unhandled error of the Flask views
+            print(ERROR_PREFIX, "{} failed: {!r}".format(path, e))
+            return {"error": "internal server error."}, 500
+        return {"error": "not found."}, 404
+
+    async def _receive_body(self, receive, headers):
+        """
+        :return: the body as received (still encoded), spooled to a temporary file past spool_size
+        :raise BodyTooLarge: the body (or its Content-Length) exceeds max_body
+        """
+        max_body = self.flaskinit.max_body
+        length = headers.get("content-length")
+        if max_body and length is not None and length.isdigit() and int(length) > max_body:
+            raise BodyTooLarge("request body of {} bytes exceeds {} bytes".format(length, max_body))
+        spool = tempfile.SpooledTemporaryFile(max_size=self.flaskinit.spool_size)
+        size = 0
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    raise ClientDisconnected()
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if max_body and size > max_body:
+                    raise BodyTooLarge("request body exceeds {} bytes".format(max_body))
+                spool.write(chunk)
+                if not message.get("more_body", False):
+                    break
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool, size
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def _published(self, futures):
+        """await the publisher futures (see FlaskInit.publish_message), a thread isn't held meanwhile"""
+        if not futures:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(asyncio.wrap_future(future) for future in futures)),
+                                   self.flaskinit.confirm_timeout)
+        except asyncio.TimeoutError:
+            for future in futures:  # withdrawn if they weren't sent yet (see FlaskInit.wait_published)
+                future.cancel()
+            raise PublishError("message wasn't confirmed in {} seconds".format(self.flaskinit.confirm_timeout))
+
+    async def _add_user(self, receive, headers):
+        spool, size = await self._receive_body(receive, headers)
+        with spool:
+            form = await self._run(self._read_form, spool, size, headers)
+        future = self.flaskinit.publish_message(form)
+        if future is None:
+            return NO_PUBLISHER
+        await self._published([future])
+        return self.flaskinit.user_config()
+
+    async def _add_snapshots(self, receive, headers, read, *args):
+        """
+        :param read: function(spool, size, headers, *args) -> (response, futures), run in the thread pool
+        """
+        spool, size = await self._receive_body(receive, headers)
+        with spool:
+            # the body is in, the request is handled now - over max_pending it is rejected (as shed_load)
+            pending = self.flaskinit.pending
+            if pending is not None and not pending.acquire(blocking=False):
+                retry_after = {"Retry-After": str(self.flaskinit.retry_after)}
+                return {"error": "server is busy, try again later."}, 429, retry_after
+            try:
+                response, futures = await self._run(read, spool, size, headers, *args)
+            finally:
+                if pending is not None:
+                    pending.release()
+        await self._published(futures)
+        return response
+
+    @staticmethod
+    def _read_form(spool, size, headers):
+        environ = {"REQUEST_METHOD": "POST", "CONTENT_TYPE": headers.get("content-type", ""),
+                   "CONTENT_LENGTH": str(size), "wsgi.input": spool}
+        _, form, _ = parse_form_data(environ)
+        return form.to_dict()
+
+    def _request_body(self, spool, size, headers):
+        """
+        :return: RequestBody of a snapshot route - the body itself or the file part of a multipart upload,
+                 None if there is no file part
+        """
+        flaskinit = self.flaskinit
+        if headers.get("content-type", "").split(";")[0].strip() == SNAPSHOT_CONTENT_TYPE:
+            encoding = headers.get("content-encoding", "identity").strip().lower()
+            return RequestBody(spool, encoding, flaskinit.spool_size, flaskinit.max_body)
+        environ = {"REQUEST_METHOD": "POST", "CONTENT_TYPE": headers.get("content-type", ""),
+                   "CONTENT_LENGTH": str(size), "wsgi.input": spool}
+        _, _, files = parse_form_data(environ)
+        if "file" not in files:
+            return None
+        return RequestBody(files["file"].stream, spool_size=flaskinit.spool_size, max_size=flaskinit.max_body)
+
+    def _read_snapshot(self, spool, size, headers, user_id, snapshot_id):
+        body = self._request_body(spool, size, headers)
+        if body is None:
+            return ({"error": "expected a serialized snapshot body or a multipart file upload."}, 400), []
+        with body as raw:
+            error, future = self.flaskinit.submit_snapshot(user_id, snapshot_id, raw)
+        return (error if error is not None else ""), [future] if future is not None else []
+
+    def _read_snapshots(self, spool, size, headers, user_id, start):
+        encoding = headers.get("content-encoding", "identity").strip().lower()
+        with RequestBody(spool, encoding, self.flaskinit.spool_size, self.flaskinit.max_body) as data:
+            return self.flaskinit.submit_snapshots(user_id, start, data)
+
+    @staticmethod
+    async def _send(send, response):
+        status, headers = 200, {}
+        if isinstance(response, tuple):
+            headers = dict(response[2]) if len(response) > 2 else {}
+            response, status = response[0], response[1]
+        body, content_type = b"", "text/html; charset=utf-8"
+        if isinstance(response, dict):
+            body, content_type = json.dumps(response).encode(), "application/json"
+        elif response:
+            body = str(response).encode()
+        headers.update({"content-type": content_type, "content-length": str(len(body))})
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                for name, value in headers.items()]})
+        await send({"type": "http.response.body", "body": body})
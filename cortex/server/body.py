@@ -0,0 +1,101 @@
+"""
+Bounded reading of request bodies.
+A body is read from the request stream in chunks (decompressed on the fly if it is encoded),
+kept in memory up to a threshold and spooled to a temporary file above it - the file is memory
+mapped, so the snapshots are parsed from it without being loaded into memory.
+"""
+
+import mmap
+import tempfile
+from cortex.compression import DECOMPRESSION_ERRORS, CompressionError, open_decompressed
+
+CHUNK_SIZE = 1 << 16
+DEFAULT_SPOOL_SIZE = 8 << 20
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class RequestBody:
+    def __init__(self, stream, encoding=None, spool_size=DEFAULT_SPOOL_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 length=None):
+        """
+        Read a request body - use as a context manager, the data is valid until it exits:
+
+            with RequestBody(request.stream) as data:
+                ...
+
+        :param stream: binary file object of the body (e.g. flask request.stream)
+        :param encoding: Content-Encoding of the body ("gzip", "zstd"), None or "identity" - not encoded
+        :param spool_size: bodies (decoded) bigger than this are spooled to a temporary file
+        :param max_size: max size of the (decoded) body, 0 - no limit
+        :param length: Content-Length of the body, if known
+        :raise BodyTooLarge: the body (or its Content-Length) exceeds max_size
+        :raise CompressionError: unsupported encoding or corrupt body
+        """
+        if max_size and length is not None and encoding in (None, "", "identity") and length > max_size:
+            raise BodyTooLarge("request body of {} bytes exceeds {} bytes".format(length, max_size))
+        self.spool_size = spool_size
+        self.max_size = max_size
+        self.size = 0
+        self.data = None  # bytes-like body
+        self._spool = None
+        self._map = None
+        if encoding not in (None, "", "identity"):
+            stream = open_decompressed(stream, encoding)
+        try:
+            self._read(stream)
+        except DECOMPRESSION_ERRORS as e:
+            self.close()
+            raise CompressionError("corrupt {} body: {}".format(encoding, e)) from None
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self, stream):
+        buf = bytearray()
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if self.max_size and self.size > self.max_size:
+                raise BodyTooLarge("request body exceeds {} bytes".format(self.max_size))
+            if self._spool is None and self.size > self.spool_size:
+                self._spool = tempfile.TemporaryFile()
+                self._spool.write(buf)
+                buf = None
+            if self._spool is None:
+                buf += chunk
+            else:
+                self._spool.write(chunk)
+        if self._spool is None:
+            self.data = buf
+        else:
+            self._spool.flush()
+            self._map = mmap.mmap(self._spool.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = self._map
+
+    @property
+    def spooled(self):
+        return self._spool is not None
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:  # views over the body are still alive, the map is closed when they are collected
+                pass
+            self._map = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self.data = None
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,80 @@
+import grpc
+from concurrent.futures import ThreadPoolExecutor
+from cortex.cortex_pb2_grpc import CortexServicer
+from google.protobuf.empty_pb2 import Empty
+from google.protobuf.message import DecodeError
+
+MAX_MESSAGE_LENGTH = 64 << 20  # a snapshot with a full HD raw color image is over 6MB
+
+
+class UploadServicer(CortexServicer):
+    def __init__(self, flaskinit):
+        """
+        gRPC Cortex service feeding the snapshot path of the Flask server (same dedup and publisher)
+
+        :param flaskinit: FlaskInit of the server
+        """
+        self.flaskinit = flaskinit
+
+    def UploadSample(self, request_iterator, context):
+        """
+        :param request_iterator: serialized snapshots (see add_upload_servicer_to_server)
+        """
+        metadata = dict(context.invocation_metadata())
+        try:
+            user_id = int(metadata["user-id"])
+            start = int(metadata.get("start", 1))
+        except (KeyError, ValueError):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "user-id and start metadata are expected.")
+
+        count = 0
+        try:
+            for raw in request_iterator:
+                error = self.flaskinit.add_snapshot(user_id, start + count, raw)
+                if error is not None:
+                    context.set_trailing_metadata((("count", str(count)),))
+                    context.abort(grpc.StatusCode.UNAVAILABLE, error["error"])
+                count += 1
+        except (DecodeError, ValueError) as e:  # malformed snapshot
+            context.set_trailing_metadata((("count", str(count)),))
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "malformed snapshot {}: {}".format(start + count, e))
+        except (OSError, RuntimeError) as e:  # saving or publishing failed (as a 500 of the Flask routes)
+            context.set_trailing_metadata((("count", str(count)),))
+            context.abort(grpc.StatusCode.UNAVAILABLE, "couldn't add snapshot {}: {}".format(start + count, e))
+        context.set_trailing_metadata((("count", str(count)),))
+        return Empty()
+
+
+def add_upload_servicer_to_server(servicer, server):
+    """
+    as cortex_pb2_grpc.add_CortexServicer_to_server, but the snapshots are handed to the servicer
+    serialized (as they arrived) - add_snapshot scans them without a protobuf round trip
+    """
+    rpc_method_handlers = {
+        'UploadSample': grpc.stream_unary_rpc_method_handler(
+            servicer.UploadSample,
+            request_deserializer=None,
+            response_serializer=Empty.SerializeToString,
+        ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler('Cortex', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+def start_grpc_server(flaskinit, host='127.0.0.1', port=50051, max_workers=16, max_pending=64):
+    """
+    start serving the Cortex gRPC service in background threads
+
+    :param flaskinit: FlaskInit whose snapshot path is fed
+    :param max_workers: number of threads handling the streams
+    :param max_pending: max number of streams handled at once, further calls fail with RESOURCE_EXHAUSTED,
+                        0 - no limit
+    :return: grpc.Server (stop it with server.stop(grace))
+    """
+    server = grpc.server(ThreadPoolExecutor(max_workers=max_workers),
+                         maximum_concurrent_rpcs=max_pending or None,
+                         options=[("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH)])
+    add_upload_servicer_to_server(UploadServicer(flaskinit), server)
+    server.add_insecure_port("{}:{}".format(host, port))
+    server.start()
+    return server
@@ -0,0 +1,208 @@
+"""
+Pre-forking mode of the server (run-server --workers N).
+The parent binds the listening socket and forks the workers, every worker accepts connections on it and
+builds its own server - FlaskInit, parsers config, message queue connection - after the fork, so snapshots
+are decoded and encoded on N cores instead of one. The segment stores are shared (appends are locked
+across processes, see cortex.segments).
+
+The parent only supervises the workers:
+    SIGHUP            graceful restart - a new generation of workers is started (re-reading parsers.yaml),
+                      then the old one is stopped
+    SIGTERM, SIGINT   graceful stop
+    a worker dying    it is replaced (after RESPAWN_DELAY if it died right after it was started)
+A worker is stopped with SIGTERM: it stops accepting connections and finishes the requests it handles,
+it is killed if it doesn't exit in grace seconds.
+"""
+
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from werkzeug.serving import make_server
+
+ERROR_PREFIX = "Error:"
+DEFAULT_GRACE = 30
+MIN_UPTIME = 1  # a worker exiting sooner than this (seconds) is respawned only after RESPAWN_DELAY
+RESPAWN_DELAY = 1
+SUPERVISOR_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+
+
+def listen(host, port, backlog=1024):
+    """:return: listening socket on host:port, inherited by the workers"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    # every worker is woken up by a connection, all but one find nothing to accept - and mustn't block on it
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _exit_description(status):
+    if os.WIFSIGNALED(status):
+        return "was killed by signal {}".format(os.WTERMSIG(status))
+    return "exited with status {}".format(os.WEXITSTATUS(status))
+
+
+class _InFlight:
+    """counts the requests being handled by a WSGI app, so that a stopping worker can wait for them"""
+
+    def __init__(self):
+        self.count = 0
+        self._done = threading.Condition()
+
+    def wrap(self, app):
+        def counted(environ, start_response):
+            with self._done:
+                self.count += 1
+            try:
+                return app(environ, start_response)
+            finally:
+                with self._done:
+                    self.count -= 1
+                    self._done.notify_all()
+        return counted
+
+    def wait(self, timeout):
+        """:return: False if requests are still being handled after timeout seconds"""
+        with self._done:
+            return self._done.wait_for(lambda: self.count == 0, timeout)
+
+
+def serve_wsgi(app, sock, grace=DEFAULT_GRACE):
+    """
+    serve a WSGI app (threaded) on a listening socket until SIGTERM or SIGINT,
+    then wait for the requests being handled - up to grace seconds
+
+    :param sock: listening socket (see listen)
+    """
+    in_flight = _InFlight()
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, in_flight.wrap(app), threaded=True, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown waits for serve_forever to return, so it can't be called by the thread serving
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    server.serve_forever()
+    server.socket.close()
+    if not in_flight.wait(grace):
+        print(ERROR_PREFIX, "worker {} stopped with {} requests in flight".format(os.getpid(), in_flight.count))
+
+
+class Supervisor:
+    def __init__(self, serve, sock, workers, grace=DEFAULT_GRACE):
+        """
+        :param serve: function(sock) run by every worker - builds the server and serves on sock until SIGTERM
+        :param sock: listening socket (see listen)
+        :param workers: number of worker processes
+        :param grace: seconds a stopped worker is given to finish its requests before it is killed
+        """
+        self.serve = serve
+        self.sock = sock
+        self.workers = workers
+        self.grace = grace
+        self.running = {}  # pid: start time, of the current generation
+        self.stopping = {}  # pid: time it is killed at, of the workers sent SIGTERM
+        self.respawns = []  # times a worker is to be started at
+
+    def spawn(self):
+        sys.stdout.flush()  # or the child prints it again
+        pid = os.fork()
+        if pid == 0:  # worker
+            status = 0
+            try:
+                signal.pthread_sigmask(signal.SIG_SETMASK, [])
+                for signum in SUPERVISOR_SIGNALS:
+                    signal.signal(signum, signal.SIG_DFL)
+                self.serve(self.sock)
+            except BaseException as e:
+                if not isinstance(e, (SystemExit, KeyboardInterrupt)):
+                    print(ERROR_PREFIX, "worker {} failed: {!r}".format(os.getpid(), e))
+                status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)  # never return into the parent's loop
+        self.running[pid] = time.monotonic()
+
+    def stop(self, pids):
+        deadline = time.monotonic() + self.grace
+        for pid in pids:
+            self.running.pop(pid, None)
+            self.stopping.setdefault(pid, deadline)
+            self._kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:  # already exited, reaped next
+            pass
+
+    def reap(self, respawn=True):
+        """collect the exited workers, a worker that wasn't stopped has died and is replaced"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.stopping.pop(pid, None) is not None:
+                continue
+            started = self.running.pop(pid, None)
+            if started is None or not respawn:
+                continue
+            print(ERROR_PREFIX, "worker {} {}, replacing it".format(pid, _exit_description(status)))
+            now = time.monotonic()
+            self.respawns.append(now + RESPAWN_DELAY if now - started < MIN_UPTIME else now)
+
+    def run(self):
+        """start the workers and supervise them until the server is stopped (SIGTERM or SIGINT)"""
+        signal.pthread_sigmask(signal.SIG_BLOCK, SUPERVISOR_SIGNALS)  # handled by sigtimedwait
+        try:
+            for _ in range(self.workers):
+                self.spawn()
+            shutting_down = False
+            while self.running or self.stopping or (self.respawns and not shutting_down):
+                info = signal.sigtimedwait(SUPERVISOR_SIGNALS, 0.5)
+                self.reap(respawn=not shutting_down)
+                now = time.monotonic()
+                if info is not None and info.si_signo == signal.SIGHUP and not shutting_down:
+                    old = list(self.running)
+                    for _ in range(self.workers):
+                        self.spawn()
+                    self.respawns.clear()
+                    self.stop(old)
+                elif info is not None and info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                    shutting_down = True
+                    self.respawns.clear()
+                    self.stop(list(self.running))
+                due = [] if shutting_down else [at for at in self.respawns if at <= now]
+                for at in due:
+                    self.respawns.remove(at)
+                    self.spawn()
+                for pid, deadline in list(self.stopping.items()):
+                    if now >= deadline:
+                        print(ERROR_PREFIX, "worker {} didn't stop in {} seconds, killing it".format(pid, self.grace))
+                        self._kill(pid, signal.SIGKILL)
+                        self.stopping[pid] = now + self.grace  # reaped once it is dead
+        finally:
+            self.stop(list(self.running))
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SUPERVISOR_SIGNALS)
+
+
+def serve_prefork(serve, host, port, workers, grace=DEFAULT_GRACE):
+    """
+    serve on host:port with workers processes forked from this one, supervised until SIGTERM or SIGINT
+
+    :param serve: function(sock) run by every worker, see Supervisor
+    """
+    with listen(host, port) as sock:
+        Supervisor(serve, sock, workers, grace).run()
@@ -1,15 +1,24 @@
-import numpy as np
 import yaml
-import json
-import copy
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from flask import Flask
 from flask import request
 from pika import BasicProperties
-from cortex.msgbrokers import find_msg_broker
-from cortex.reader import parse_from
-from google.protobuf.json_format import MessageToDict, MessageToJson, ParseDict
+from cortex.arrays import snapshot_arrays
+from cortex.compression import CompressionError, available_codecs
+from cortex.formats import iter_records
+from cortex.messages import DEFAULT_FORMAT, available_formats, encode_message, snapshot_message
+from cortex.msgbrokers import PublishError, find_msg_publisher
+from cortex.reader import create_empty_snapshot
+from cortex.segments import DEFAULT_SEGMENT_SIZE
+from .body import DEFAULT_MAX_SIZE, DEFAULT_SPOOL_SIZE, BodyTooLarge, RequestBody
+from .prefork import DEFAULT_GRACE, serve_prefork, serve_wsgi
+from .storage import ERROR_PREFIX, BlobWriter, DataStore, StorageBusy
 from pathlib import Path
-from secrets import token_hex
+
+SNAPSHOT_CONTENT_TYPE = "application/x-protobuf"
 
 
 def get_parsers():
@@ -26,85 +35,389 @@ def get_parsers():
     return {}
 
 
-def save_data(parsers, snapshot):
+def parser_fields(parsers):
     """
-    save data is looking for 'data' field (as it stores the 'big data', based on the cortex.proto)
+    snapshot fields consumed by each parser: the 'fields' option of the parser in parsers.yaml,
+    by default the snapshot field named after the parser. datetime is always included (timestamp of the results)
 
     :param parsers: parsers as a dict (as return value of get_parsers())
-    :param snapshot: as protobuf object
-    :return: paths dict {parser_name : path__where_data_is_stored}
+    :return: {parser_name: [snapshot field, ...]}
     """
-    parser_paths = {}
-    # parsers as appear in the parsers.yaml file should include path option
-    # which will be used for saving big data
+    snapshot_fields = set(create_empty_snapshot().DESCRIPTOR.fields_by_name)
+    fields = {}
     for parser, config in parsers.items():
-        if config is not None and "path" in config:
-            parser_dir = Path(config["path"])
-            parser_dir.mkdir(parents=True, exist_ok=True)
-            parser_paths[parser] = parser_dir
-
-    for desc, val in snapshot.ListFields():
-        if desc.name in parser_paths:
-            if desc.name == "color_image":  # save bytes object
-                parser_paths[desc.name] = parser_paths[desc.name] / ("data_" + token_hex(5) + ".snap")
-                with open(parser_paths[desc.name], "wb") as f:
-                    f.write(snapshot.color_image.data)
-            elif desc.name == "depth_image":  # save numpy array
-                parser_paths[desc.name] = parser_paths[desc.name] / ("data_" + token_hex(5) + ".npy")
-                np.save(parser_paths[desc.name], snapshot.depth_image.data)
-    return parser_paths
-
-
-def snapshot_to_dict(parsers, snapshot_path, snapshot):
-    """
-    ParseDict (see next line) function raises an error in Rabbitmq because it can't recognize protobuf descriptors
-    serial_dic = ParseDict(dic_snap, create_empty_snapshot(), ignore_unknown_fields=True)
-    so we created a copy (of type dictionary)
+        if config is not None and "fields" in config:
+            needed = list(config["fields"])
+        else:
+            needed = [parser] if parser in snapshot_fields else []
+        fields[parser] = needed + (["datetime"] if "datetime" not in needed else [])
+    return fields
 
-    :param parsers: parsers as a dict (as return value of get_parsers())
-    :param snapshot_path: a path that will help us to relate a snapshot to a user (users/user_id/snapshots/snapshot_id)
-    :param snapshot: protobuf object
-    :return: serialized dictionary
+
+class MalformedSnapshot(ValueError):
+    pass
+
+
+def body_error_response(error, encoding):
+    """
+    :param error: BodyTooLarge or CompressionError raised reading a request body,
+                  or MalformedSnapshot raised decoding it
+    :param encoding: Content-Encoding of the request
+    :return: error response (413, 415 - unsupported encoding, or 400)
     """
-    data_paths = save_data(parsers, snapshot)
+    if isinstance(error, BodyTooLarge):
+        return {"error": str(error)}, 413
+    if isinstance(error, MalformedSnapshot):  # not to be retried by the client
+        return {"error": str(error)}, 400
+    if encoding not in ("", "identity") and encoding not in available_codecs():
+        return {"error": str(error)}, 415
+    return {"error": str(error)}, 400
+
+
+class RecentIds:
+    def __init__(self, maxsize=100000):
+        """
+        bounded index of recently published keys (e.g. (user_id, snapshot_id)), least recently used are evicted
+
+        :param maxsize: max number of keys, 0 - disabled (nothing is ever a duplicate)
+        """
+        self.maxsize = maxsize
+        self._keys = OrderedDict()  # key: Future of its publish, done once it is published
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        :return: (Future of the publish of key, True if key is reserved by this call - it wasn't published
+                 nor is being published, the caller settles it with settle or release)
+        """
+        if self.maxsize <= 0:
+            published = Future()
+            published.set_running_or_notify_cancel()
+            return published, True
+        with self._lock:
+            published = self._keys.get(key)
+            if published is not None:
+                self._keys.move_to_end(key)
+                return published, False
+            published = self._keys[key] = Future()
+            published.set_running_or_notify_cancel()  # not cancelled by a duplicate giving up waiting for it
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return published, True
 
-    dic_snap = MessageToDict(snapshot, including_default_value_fields=True, preserving_proto_field_name=True)
-    # replace data attr with data_path
-    for parser, data_path in data_paths.items():
-        if parser in dic_snap:
-            del dic_snap[parser]["data"]
-            dic_snap[parser]["data_path"] = str(data_paths[parser])
+    @staticmethod
+    def settle(published):
+        """
+        :param published: Future returned by claim, set - its key is published, only now are the duplicates
+                          acknowledged
+        """
+        published.set_result(None)
 
-    # add snapshot path (will be used to relate between the user and its snapshots)
-    dic_snap["snapshot_path"] = snapshot_path if snapshot_path else ""
-    # print("ds:", dic_snap)
+    def release(self, key, published, error):
+        """cancel a claim (publishing failed), so that a retry isn't considered a duplicate"""
+        with self._lock:
+            if self._keys.get(key) is published:
+                del self._keys[key]
+        published.set_exception(error)  # the duplicates waiting for it fail as well (and are retried)
 
-    new_snap_dic = copy.deepcopy(dic_snap)
-    return json.dumps(new_snap_dic)
+    def follow(self, key, published, future):
+        """settle or release a claim once the publish future is done"""
+        def done(f):
+            error = PublishError("message was withdrawn") if f.cancelled() else f.exception()
+            if error is None:
+                self.settle(published)
+            else:
+                self.release(key, published, error)
+        future.add_done_callback(done)
 
 
 class FlaskInit:
-    def __init__(self, publish=None, msg_queue_url=""):
+    def __init__(self, publish=None, msg_queue_url="", dedup_size=100000, max_pending=64, retry_after=1,
+                 grpc_port=None, max_body=DEFAULT_MAX_SIZE, spool_size=DEFAULT_SPOOL_SIZE, publish_batch=256,
+                 confirm_timeout=10, message_format=DEFAULT_FORMAT, write_workers=0, write_queue=256,
+                 fsync="never", segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        :param publish: function publishing a message (dict), used instead of the message queue
+        :param msg_queue_url: e.g 'rabbitmq://127.0.0.1:5672/'
+        :param dedup_size: number of recent (user_id, snapshot_id) kept to drop re-uploaded snapshots, 0 - disabled
+        :param max_pending: max number of snapshot requests handled at once, further requests are rejected
+                            with 429 Too Many Requests (instead of queueing until they time out), 0 - no limit
+        :param retry_after: delay (seconds) suggested to the rejected clients (Retry-After header)
+        :param grpc_port: port of the gRPC upload service, advertised to the clients (see run_server)
+        :param max_body: max size (bytes) of a decoded request body, bigger ones are rejected with 413, 0 - no limit
+        :param spool_size: request bodies bigger than this (bytes) are spooled to a temporary file
+                           instead of being kept in memory (see cortex.server.body)
+        :param publish_batch: max number of messages published to the message queue at once
+        :param confirm_timeout: seconds to wait for the message queue to confirm a message,
+                                the request fails (and is retried by the client) past it
+        :param message_format: encoding of the messages published to the message queue, "json" or "msgpack"
+                               (see cortex.messages)
+        :param write_workers: number of threads writing the snapshot data behind the requests
+                              (see cortex.server.storage), 0 - the data is written and published by the request.
+                              Behind the requests a snapshot is acknowledged before it is published: one that then
+                              fails to be published (e.g. the message queue is down) is only logged, the client
+                              doesn't upload it again - it is lost
+        :param write_queue: max number of snapshots waiting to be written, requests wait (and fail with 503
+                            after confirm_timeout) above it
+        :param fsync: "never" or "always" - fsync the data before publishing
+        :param segment_size: size (bytes) of the segment files the snapshot data is appended to
+                             (see cortex.segments)
+        """
         self.publish = publish
         self.msg_queue_url = msg_queue_url
         self.parsers = get_parsers()
-        self.msg_broker = None
+        self.msg_broker = None  # long-lived publisher of the message queue, see connect()
+        self._msg_broker_lock = threading.Lock()
+        self.publish_batch = publish_batch
+        self.confirm_timeout = confirm_timeout
+        if message_format not in available_formats():
+            raise ValueError("unavailable message format: {}".format(message_format))
+        self.message_format = message_format
+        self.fsync = fsync
+        self.store = DataStore(self.parsers, segment_size)
+        self.writer = BlobWriter(self.store, write_workers, write_queue, fsync,
+                                 confirm_timeout) if write_workers > 0 else None
+        self.recent_snapshots = RecentIds(dedup_size)
+        self.pending = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self.retry_after = retry_after
+        self.grpc_port = grpc_port
+        self.max_body = max_body
+        self.spool_size = spool_size
 
-    def setup_publisher(self, data, props=None):
+    def connect(self):
+        """
+        open the connection to the message queue (once per process - call it in the worker process),
+        it is kept open and reopened if it fails
+
+        :return: the publisher, None if there is no message queue url
+        """
+        if self.publish or self.msg_queue_url == "":
+            return None
+        with self._msg_broker_lock:
+            if self.msg_broker is None:
+                self.msg_broker = find_msg_publisher(self.msg_queue_url, batch_size=self.publish_batch)
+            return self.msg_broker
+
+    def close(self):
+        """
+        write and publish the pending snapshots, flush the pending messages and close the connection
+        to the message queue
+        """
+        if self.writer is not None:
+            self.writer.close()
+        self.store.close()
+        with self._msg_broker_lock:
+            msg_broker, self.msg_broker = self.msg_broker, None
+        if msg_broker is not None:
+            msg_broker.close(self.confirm_timeout)
+
+    def publish_message(self, message, props=None):
+        """
+        publish without waiting
+
+        :param message: dict, handed as is to the publish function or encoded in message_format for the queue
+        :return: concurrent.futures.Future set once the message is published (confirmed by the message queue),
+                 None if there is no publisher and no message queue url
+        """
         if self.publish:
-            self.publish(json.loads(data))
-        elif self.msg_queue_url != "":
-            with find_msg_broker(self.msg_queue_url) as msq:
-                msq.declare_exchange()
-                msq.publish(data, props)
-        else:
+            future = Future()
+            try:
+                self.publish(message)
+                future.set_result(None)
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self.msg_queue_url != "":
+            body, content_type = encode_message(message, self.message_format)
+            props = props if props is not None else BasicProperties()
+            props.content_type = content_type
+            # messages of concurrent requests go out together, each request waits for the confirm of its own
+            return self.connect().publish(body, props)
+        return None
+
+    def wait_published(self, future):
+        """
+        :param future: as returned by publish_message
+        :raise PublishError: the message queue didn't confirm the message (in confirm_timeout)
+        """
+        try:
+            future.result(self.confirm_timeout)
+        except FutureTimeoutError:
+            future.cancel()  # withdrawn if it wasn't sent yet, so that the retry of the client isn't a duplicate
+            raise PublishError("message wasn't confirmed in {} seconds".format(self.confirm_timeout)) from None
+
+    def setup_publisher(self, message, props=None):
+        """
+        :param message: dict, handed as is to the publish function or encoded in message_format for the queue
+        :return: False if there is no publisher and no message queue url
+        :raise PublishError: the message queue didn't confirm the message
+        """
+        future = self.publish_message(message, props)
+        if future is None:
             return False
+        self.wait_published(future)
         return True
 
+    def submit_snapshot(self, user_id, snapshot_id, raw):
+        """
+        save the big data of a serialized snapshot and publish the snapshot, without waiting for it to be published.
+        With write behind (write_workers) both happen after this returns, the snapshot is published once its data
+        is written.
+
+        A snapshot that was recently published (same user_id and snapshot_id, e.g. a resumed upload)
+        is acknowledged without being published again, one that is being published once it is published.
+
+        :param raw: serialized snapshot (bytes-like)
+        :return: (error dict or None, concurrent.futures.Future set once the snapshot is published, None if there is
+                 nothing to wait for - a snapshot published behind the request)
+        :raise MalformedSnapshot: raw isn't a valid serialized snapshot
+        """
+        if not self.publish and self.msg_queue_url == "":
+            return {"error": "no publisher and no message queue url were supplied."}, None
+        key = (user_id, snapshot_id)
+        published, claimed = self.recent_snapshots.claim(key)
+        if not claimed:  # acknowledged once the snapshot is published, failing if publishing it fails
+            return None, published
+        try:
+            snapshot_path = Path("users") / str(user_id) / "snapshots" / str(snapshot_id)
+            try:
+                arrays = snapshot_arrays(raw)
+                message = snapshot_message(raw, str(snapshot_path))
+            except ValueError as e:
+                raise MalformedSnapshot("malformed snapshot {}: {}".format(snapshot_id, e)) from None
+            blobs = self.store.blobs(arrays)
+            props = BasicProperties(headers={"snapshot_id": snapshot_id, "user_id": user_id},
+                                    message_id="snap_"+str(snapshot_id)+"_"+str(user_id))
+
+            def with_data(written):  # data_path - segment reference of the blob (see cortex.segments)
+                for field, fields in written.items():
+                    message[field].update(fields)
+                return message
+
+            if self.writer is not None:  # published by the writer once the data is written, after the response
+                def publish(written):
+                    self.setup_publisher(with_data(written), props)
+                    self.recent_snapshots.settle(published)
+
+                self.writer.submit(user_id, snapshot_id, blobs, publish,
+                                   functools.partial(self._store_failed, key, published))
+                return None, None
+            written = self.store.write(user_id, snapshot_id, blobs, self.fsync == "always")
+            future = self.publish_message(with_data(written), props)
+        except Exception as e:
+            self.recent_snapshots.release(key, published, e)
+            raise
+        # a retry of a snapshot that wasn't published isn't a duplicate
+        self.recent_snapshots.follow(key, published, future)
+        return None, future
+
+    def add_snapshot(self, user_id, snapshot_id, raw):
+        """
+        as submit_snapshot, waiting for the snapshot to be published (if it isn't published behind the request)
+
+        :return: error dict, None on success
+        """
+        error, future = self.submit_snapshot(user_id, snapshot_id, raw)
+        if future is not None:
+            self.wait_published(future)
+        return error
+
+    def _store_failed(self, key, published, error):
+        """
+        a snapshot wasn't written or published behind the request, its claim is released
+        so that uploading it again stores it
+        """
+        self.recent_snapshots.release(key, published, error)
+        print(ERROR_PREFIX, "couldn't store snapshot {} of user {}: {}".format(key[1], key[0], error))
+
+    def submit_snapshots(self, user_id, start, body):
+        """
+        as submit_snapshot for a batch
+
+        :param body: framed serialized snapshots (see cortex.formats.frame_records)
+        :param start: snapshot id of the first snapshot
+        :return: (response of the batch route, [futures of the snapshots to wait for])
+        """
+        try:
+            records = list(iter_records(body))
+        except ValueError as e:
+            return ({"error": "malformed snapshots batch: {}".format(e)}, 400), []
+
+        futures = []
+        for i, raw in enumerate(records):
+            try:
+                error, future = self.submit_snapshot(user_id, start + i, raw)
+            except MalformedSnapshot as e:  # the snapshots before it were submitted
+                return ({"error": str(e)}, 400), futures
+            if error is not None:
+                return error, futures
+            if future is not None:
+                futures.append(future)
+        return {"count": len(records)}, futures
+
+    def add_snapshots(self, user_id, start, body):
+        """
+        as submit_snapshots, waiting for the snapshots to be published - they are published together
+
+        :return: response of the batch route
+        """
+        response, futures = self.submit_snapshots(user_id, start, body)
+        for future in futures:
+            self.wait_published(future)
+        return response
+
+    def user_config(self):
+        """
+        :return: response of /new_user - list of available parsers, the snapshot fields they need
+                 (clients send only these fields), the accepted Content-Encoding codecs and the gRPC port
+        """
+        parsers = [k for k in self.parsers.keys()]
+        config = {"parsers": parsers, "fields": parser_fields(self.parsers), "codecs": available_codecs()}
+        if self.grpc_port is not None:
+            config["grpc_port"] = self.grpc_port
+        return config
+
+    def shed_load(self, view):
+        """
+        route decorator: requests over max_pending are rejected right away with 429 and Retry-After,
+        instead of queueing until the clients time out
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.pending is None:
+                return view(*args, **kwargs)
+            if not self.pending.acquire(blocking=False):
+                return {"error": "server is busy, try again later."}, 429, {"Retry-After": str(self.retry_after)}
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self.pending.release()
+        return wrapper
+
     def create_app(self):
         """Initialize the core application."""
         app = Flask(__name__)
 
+        def request_body(stream=None):
+            """
+            :param stream: body stream, by default the request stream (decoded according to its Content-Encoding)
+            :return: RequestBody (context manager of the body data)
+            :raise BodyTooLarge: the body exceeds max_body
+            :raise CompressionError: unsupported encoding or corrupt body
+            """
+            if stream is not None:
+                return RequestBody(stream, spool_size=self.spool_size, max_size=self.max_body)
+            encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+            return RequestBody(request.stream, encoding, self.spool_size, self.max_body, request.content_length)
+
+        def body_error(error):
+            """:return: error response of a body that couldn't be read (or decoded)"""
+            return body_error_response(error, request.headers.get("Content-Encoding", "identity").strip().lower())
+
+        @app.errorhandler(StorageBusy)
+        def storage_busy(error):
+            return {"error": str(error)}, 503, {"Retry-After": str(self.retry_after)}
+
         with app.app_context():
             # Include our Routes
 
@@ -112,39 +425,55 @@ class FlaskInit:
             def add_user():
                 assert request.method == 'POST'
 
-                if not self.setup_publisher(json.dumps(request.form.to_dict())):
+                if not self.setup_publisher(request.form.to_dict()):
                     data = {"error": "no publisher and no message queue url were supplied."}
                     return data
-
-                parsers = [k for k in self.parsers.keys()]
-                # return list of available parsers
-                return {"parsers": parsers}
+                return self.user_config()
 
             @app.route('/snapshot/<int:user_id>/<int:snapshot_id>', methods=['POST'])
+            @self.shed_load
             def add_snapshot(user_id, snapshot_id):
+                try:
+                    if request.mimetype == SNAPSHOT_CONTENT_TYPE:  # serialized snapshot as the request body
+                        body = request_body()
+                    else:  # multipart upload of the serialized snapshot as a file
+                        body = request_body(request.files["file"].stream)
+                except (BodyTooLarge, CompressionError) as e:
+                    return body_error(e)
 
-                snapshot_path = Path("users") / str(user_id) / "snapshots" / str(snapshot_id)
-                Path(snapshot_path).mkdir(parents=True, exist_ok=True)
-                snap_file = request.files["file"].filename
-                with open(snap_file, "rb") as f:
-                    snap = parse_from(f.read())
-                    snap_serial_dic = snapshot_to_dict(self.parsers, str(snapshot_path), snap)
-
-                if not self.setup_publisher(
-                        snap_serial_dic,
-                        BasicProperties(
-                            headers={"snapshot_id": snapshot_id, "user_id": user_id},
-                            message_id="snap_"+str(snapshot_id)+"_"+str(user_id))
-                ):
-                    data = {"error": "no publisher and no message queue url were supplied."}
+                try:
+                    with body as raw:
+                        error = self.add_snapshot(user_id, snapshot_id, raw)
+                except MalformedSnapshot as e:
+                    return body_error(e)
+                if error is not None:
                     # headers = {"Content-Type": "application/json"}
-                    return data
+                    return error
                 return ""
 
+            @app.route('/snapshots/<int:user_id>', methods=['POST'])
+            @self.shed_load
+            def add_snapshots(user_id):
+                """
+                batch upload: the body holds many serialized snapshots framed as in a sample file
+                (each prefixed by its length), the first one has snapshot_id = start (query parameter)
+                """
+                start = request.args.get("start", 1, type=int)
+                try:
+                    body = request_body()
+                except (BodyTooLarge, CompressionError) as e:
+                    return body_error(e)
+                with body as data:
+                    return self.add_snapshots(user_id, start, data)
+
             return app
 
 
-def run_server(host='127.0.0.1', port=8000, publish=None, msg_queue_url=""):
+def run_server(host='127.0.0.1', port=8000, publish=None, msg_queue_url="", dedup_size=100000, max_pending=64,
+               retry_after=1, grpc_port=None, max_body=DEFAULT_MAX_SIZE, spool_size=DEFAULT_SPOOL_SIZE,
+               publish_batch=256, confirm_timeout=10, message_format=DEFAULT_FORMAT, write_workers=0, write_queue=256,
+               fsync="never", segment_size=DEFAULT_SEGMENT_SIZE, asgi=False, asgi_workers=8, workers=0,
+               grace=DEFAULT_GRACE):
     """
     run server on host:port and publish results with supplied publish function
     otherwise publish snapshots to msgqueue
@@ -153,12 +482,67 @@ def run_server(host='127.0.0.1', port=8000, publish=None, msg_queue_url=""):
     :param port:
     :param publish:
     :param msg_queue_url: e.g 'rabbitmq://127.0.0.1:5672/'
+    :param dedup_size: number of recent (user_id, snapshot_id) kept to drop re-uploaded snapshots, 0 - disabled
+    :param max_pending: max number of snapshot requests handled at once (429 above it), 0 - no limit
+    :param retry_after: delay (seconds) suggested to the rejected clients
+    :param grpc_port: if supplied, the gRPC upload service (see cortex.server.grpc_server)
+                      is served on host:grpc_port as well, publishing the same way
+    :param max_body: max size (bytes) of a decoded request body (413 above it), 0 - no limit
+    :param spool_size: request bodies bigger than this (bytes) are spooled to disk
+    :param publish_batch: max number of messages published to the message queue at once
+    :param confirm_timeout: seconds to wait for the message queue to confirm a message
+    :param message_format: encoding of the messages published to the message queue, "json" or "msgpack"
+    :param write_workers: number of threads writing the snapshot data behind the requests, 0 - synchronously
+                          (the default - a snapshot written behind its request is acknowledged before it is
+                          published, and lost if publishing it fails)
+    :param write_queue: max number of snapshots waiting to be written
+    :param fsync: "never" or "always" - fsync the data before publishing
+    :param segment_size: size (bytes) of the segment files the snapshot data is appended to
+    :param asgi: serve the async app (see cortex.server.asgi) with uvicorn instead of the Flask app
+    :param asgi_workers: number of threads decoding and saving the snapshots of the async app
+    :param workers: number of worker processes sharing host:port (see cortex.server.prefork),
+                    0 - served by this process
+    :param grace: seconds a stopped worker is given to finish its requests
     :return:
     """
-    if publish is None and msg_queue_url != "":
-        flaskinit = FlaskInit(msg_queue_url=msg_queue_url)
-    else:
-        flaskinit = FlaskInit(publish)
-    app = flaskinit.create_app()
-    app.run(host, port)
+    options = dict(dedup_size=dedup_size, max_pending=max_pending, retry_after=retry_after, grpc_port=grpc_port,
+                   max_body=max_body, spool_size=spool_size, publish_batch=publish_batch,
+                   confirm_timeout=confirm_timeout, message_format=message_format, write_workers=write_workers,
+                   write_queue=write_queue, fsync=fsync, segment_size=segment_size)
+
+    def serve(sock=None):
+        """
+        build the server and serve until it is stopped - in every worker process (after the fork) with workers
 
+        :param sock: listening socket shared by the workers, None - listen on host:port
+        """
+        if publish is None and msg_queue_url != "":
+            flaskinit = FlaskInit(msg_queue_url=msg_queue_url, **options)
+        else:
+            flaskinit = FlaskInit(publish, **options)
+        flaskinit.connect()  # a single connection to the message queue (per process), opened at startup
+        grpc_server = None
+        if grpc_port is not None:
+            from .grpc_server import start_grpc_server  # grpcio is needed only here
+            # the workers share the port as well (gRPC sets SO_REUSEPORT)
+            grpc_server = start_grpc_server(flaskinit, host, grpc_port, max_pending=max_pending)
+        try:
+            if asgi:
+                import uvicorn  # uvicorn is needed only here
+                from .asgi import AsgiApp
+                # uvicorn stops gracefully on SIGTERM itself
+                listening = dict(host=host, port=port) if sock is None else dict(fd=sock.fileno())
+                uvicorn.run(AsgiApp(flaskinit, asgi_workers), **listening)
+            elif sock is None:
+                flaskinit.create_app().run(host, port)
+            else:
+                serve_wsgi(flaskinit.create_app(), sock, grace)
+        finally:
+            if grpc_server is not None:
+                grpc_server.stop(grace=5)
+            flaskinit.close()
+
+    if workers > 0:
+        serve_prefork(serve, host, port, workers, grace)
+    else:
+        serve()
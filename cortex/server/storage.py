@@ -0,0 +1,127 @@
+"""
+Storage of the snapshot images.
+The images are appended to segment stores (see cortex.segments), one per parser with a path option,
+by a pool of writer threads fed through a bounded queue (write behind) - a request doesn't wait
+for the disk, unless the writers are behind by more than the queue. The price is that the request
+is acknowledged before its snapshot is published, a snapshot failing to be published is only logged
+(so write behind is off by default, see FlaskInit write_workers).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cortex.depth import depth_codec, encode_depth
+from cortex.segments import DEFAULT_SEGMENT_SIZE, SegmentStore
+
+ERROR_PREFIX = "Error:"
+FSYNC_POLICIES = ("never", "always")
+
+
+class StorageBusy(RuntimeError):
+    pass
+
+
+class DataStore:
+    def __init__(self, parsers, max_segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        :param parsers: parsers as a dict (as return value of get_parsers()),
+                        the images of the parsers with a path option are stored under it,
+                        depth images with the codec of the depth_image parser (see cortex.depth)
+        :param max_segment_size: size (bytes) of the segments
+        :raise DepthCodecError: invalid codec options
+        """
+        self.stores = {}  # field name: SegmentStore
+        for parser, config in parsers.items():
+            if parser in ("color_image", "depth_image") and config is not None and "path" in config:
+                self.stores[parser] = SegmentStore(config["path"], max_segment_size)
+        self.depth_codec, self.depth_scale = depth_codec(parsers.get("depth_image"))
+
+    def blobs(self, arrays):
+        """
+        :param arrays: SnapshotArrays of the snapshot (see cortex.arrays)
+        :return: {field name: blob} of the images to store - the color image data as it is
+                 (raw RGB or encoded), the depth image array (encoded when it is written)
+        """
+        blobs = {}
+        if "color_image" in self.stores and arrays.color is not None:
+            blobs["color_image"] = arrays.color
+        if "depth_image" in self.stores and arrays.depth is not None:
+            blobs["depth_image"] = arrays.depth
+        return blobs
+
+    def write(self, user_id, snapshot_id, blobs, fsync=False):
+        """
+        :return: {field name: fields added to its message} - data_path (segment reference of the blob),
+                 and codec and scale of the depth image
+        """
+        written = {}
+        for field, blob in blobs.items():
+            if field == "depth_image":
+                blob = encode_depth(blob, self.depth_codec, self.depth_scale)
+                written[field] = {"codec": self.depth_codec}
+                if self.depth_codec == "uint16":
+                    written[field]["scale"] = self.depth_scale
+            written.setdefault(field, {})["data_path"] = self.stores[field].append(user_id, snapshot_id, blob, fsync)
+        return written
+
+    def fetch(self, user_id, snapshot_id, field):
+        """
+        :return: read-only memoryview of the blob of a field of a snapshot (mapped, see SegmentStore.fetch)
+        :raise KeyError: the field isn't stored or the snapshot has no blob of it
+        """
+        return self.stores[field].fetch(user_id, snapshot_id)
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+
+class BlobWriter:
+    def __init__(self, store, workers=4, max_queue=256, fsync="never", timeout=10):
+        """
+        :param store: DataStore the blobs are written to
+        :param workers: number of writer threads
+        :param max_queue: max number of snapshots queued or being written, submit blocks above it
+        :param fsync: "never" - leave flushing to the OS, "always" - fsync every blob before its snapshot is published
+        :param timeout: max seconds submit waits for room in the queue
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy: {}".format(fsync))
+        self.store = store
+        self.fsync = fsync == "always"
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="blob-writer")
+
+    def submit(self, user_id, snapshot_id, blobs, on_written, on_error=None):
+        """
+        queue the blobs of a snapshot to be written
+
+        :param blobs: as returned by DataStore.blobs, they must stay valid until they are written
+        :param on_written: function(written fields, see DataStore.write) called (by the writer thread)
+                           once the blobs are written, e.g. to publish the snapshot
+        :param on_error: function(exception) called if writing or on_written fail
+        :raise StorageBusy: the queue stayed full for timeout seconds
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise StorageBusy("storage is busy, {} snapshots are waiting to be written".format(self.max_queue))
+        try:
+            self._executor.submit(self._write, user_id, snapshot_id, blobs, on_written, on_error)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _write(self, user_id, snapshot_id, blobs, on_written, on_error):
+        try:
+            on_written(self.store.write(user_id, snapshot_id, blobs, self.fsync))
+        except Exception as e:
+            if on_error is None:
+                print(ERROR_PREFIX, "couldn't store snapshot data:", e)
+            else:
+                on_error(e)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """wait for the queued snapshots to be written (and published)"""
+        self._executor.shutdown(wait=True)
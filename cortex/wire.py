@@ -0,0 +1,127 @@
+"""
+Minimal protobuf wire format scanner.
+It locates fields inside a serialized message without decoding (or copying) their values,
+so that big payloads such as the images of a snapshot can be skipped or viewed in place.
+See https://developers.google.com/protocol-buffers/docs/encoding
+"""
+
+import struct
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+
+class WireError(ValueError):
+    pass
+
+
+def read_varint(buf, pos):
+    """
+    :param buf: bytes-like object
+    :param pos: position of the varint
+    :return: (value, position after the varint)
+    """
+    result = 0
+    shift = 0
+    try:
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                return result, pos
+            shift += 7
+            if shift >= 64:
+                raise WireError("varint is too long")
+    except IndexError:
+        raise WireError("truncated varint") from None
+
+
+def iter_fields(buf, start=0, end=None):
+    """
+    Generator over the fields of a serialized message.
+
+    :param buf: bytes-like object
+    :param start: position of the message in buf
+    :param end: end position of the message in buf
+    :return: yields (field number, wire type, field start, value start, value end)
+             where field start is the position of the field key
+    """
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        field_start = pos
+        key, pos = read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == VARINT:
+            _, value_end = read_varint(buf, pos)
+        elif wire_type == FIXED64:
+            value_end = pos + 8
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value_end = pos + length
+        elif wire_type == FIXED32:
+            value_end = pos + 4
+        else:
+            raise WireError("unsupported wire type {} of field {}".format(wire_type, number))
+        if value_end > end:
+            raise WireError("field {} exceeds the message end".format(number))
+        yield number, wire_type, field_start, pos, value_end
+        pos = value_end
+
+
+def scan_fields(buf, start=0, end=None):
+    """
+    :return: {field number: [(wire type, field start, value start, value end), ...]}
+             occurrences are kept in order of appearance
+    """
+    fields = {}
+    for number, wire_type, field_start, value_start, value_end in iter_fields(buf, start, end):
+        fields.setdefault(number, []).append((wire_type, field_start, value_start, value_end))
+    return fields
+
+
+def decode_scalar(buf, wire_type, start, fmt=None):
+    """
+    decode a scalar field value
+
+    :param wire_type: wire type of the field
+    :param start: value start position
+    :param fmt: struct format for fixed size values (e.g. "<d" for double, "<f" for float)
+    :return: decoded value
+    """
+    if wire_type == VARINT:
+        return read_varint(buf, start)[0]
+    if wire_type == FIXED64:
+        return struct.unpack_from(fmt or "<Q", buf, start)[0]
+    if wire_type == FIXED32:
+        return struct.unpack_from(fmt or "<I", buf, start)[0]
+    raise WireError("wire type {} is not a scalar".format(wire_type))
+
+
+def encode_varint(value):
+    """:return: value (non negative) encoded as a varint"""
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def encode_field(number, wire_type, value):
+    """
+    :param value: int for VARINT fields, bytes-like for LENGTH_DELIMITED fields
+    :return: the serialized field (key and value)
+    """
+    key = encode_varint(number << 3 | wire_type)
+    if wire_type == VARINT:
+        return key + encode_varint(value)
+    if wire_type == LENGTH_DELIMITED:
+        return key + encode_varint(len(value)) + bytes(value)
+    raise WireError("unsupported wire type {} of field {}".format(wire_type, number))